@@ -0,0 +1,163 @@
+import pickle
+import itertools
+import numpy as np
+
+from sweep import grid_values, axis_grid, make_task, read_point, run_tasks, summary_key
+
+# Detection thresholds by bisection in SNR. What we read off a sweep is
+# mostly the SNR at which the significance of each gas crosses 3 and 5
+# sigma, for each value of the other axes (a row). Instead of the whole SNR
+# grid, each row starts from the two ends of the SNR range, and every
+# round runs the midpoint (in ln SNR) of each bracket that still holds a
+# crossing. A bracket is finished when hi/lo - 1 < tolerance. This assumes
+# the significance increases with SNR.
+#
+# Options are read from the 'adaptive' block of a sweep spec:
+#   thresholds   significances to locate
+#   tolerance    relative width of the final SNR brackets
+#   max_rounds   maximum number of rounds of retrievals
+
+THRESHOLDS = [3.0, 5.0]
+TOLERANCE = 0.05
+MAX_ROUNDS = 10
+
+def adaptive_options(spec):
+    opts = dict(spec.get('adaptive') or {})
+    opts.setdefault('thresholds', THRESHOLDS)
+    opts.setdefault('tolerance', TOLERANCE)
+    opts.setdefault('max_rounds', MAX_ROUNDS)
+    return opts
+
+def snr_key(SNR):
+    # rounded like the output filenames, so points are reused on reruns
+    return round(float(SNR), 5)
+
+def new_bracket(lo, hi):
+    return {'lo': lo, 'hi': hi, 'status': 'open'}
+
+def significance(results, row, SNR, label):
+    return results[(row, SNR)]['sig_'+label]
+
+def above(results, row, SNR, label, threshold):
+    # A Savage-Dickey significance with too few posterior samples near the
+    # prior edge is only a lower limit (see detection.savage_dickey_lnB),
+    # which can not place a threshold above it.
+    sig = significance(results, row, SNR, label)
+    if sig < threshold and results[(row, SNR)].get('sig_lower_limit_'+label, False):
+        raise Exception('The Savage-Dickey significance of '+label+' at SNR '+str(SNR)
+                        +' is only a lower limit of %.2f sigma, '%sig
+                        +'so the %g sigma threshold can not be found. '%threshold
+                        +'Use detection: two_run for it.')
+    return sig >= threshold
+
+def update_bracket(br, results, row, label, threshold, tolerance):
+    # Narrows the bracket with the points that have been run. Returns the
+    # SNR that must be run next, or None when the bracket is finished.
+    # status is 'resolved', or 'below'/'above' when the crossing is
+    # outside the SNR range.
+    while br['status'] == 'open':
+        for SNR in (br['lo'], br['hi']):
+            if (row, SNR) not in results:
+                return SNR
+        if above(results, row, br['lo'], label, threshold):
+            br['status'] = 'below'
+            break
+        if not above(results, row, br['hi'], label, threshold):
+            br['status'] = 'above'
+            break
+        mid = snr_key(np.sqrt(br['lo']*br['hi']))
+        if br['hi']/br['lo'] - 1 < tolerance or mid in (br['lo'], br['hi']):
+            br['status'] = 'resolved'
+            break
+        if (row, mid) not in results:
+            return mid
+        if above(results, row, mid, label, threshold):
+            br['hi'] = mid
+        else:
+            br['lo'] = mid
+    return None
+
+def crossing(br, results, row, label, threshold):
+    # SNR of the crossing, interpolated in ln SNR within the bracket
+    if br['status'] != 'resolved':
+        return None
+    x = np.log([br['lo'], br['hi']])
+    y = [significance(results, row, br['lo'], label), significance(results, row, br['hi'], label)]
+    if y[1] == y[0]:
+        return float(np.exp(np.mean(x)))
+    return float(np.exp(x[0] + (threshold - y[0])*(x[1] - x[0])/(y[1] - y[0])))
+
+def write_thresholds(sweep, outfile=None):
+    spec = sweep['spec']
+    if outfile is None:
+        outfile = spec['save_dir']+'/'+spec['name']+'_thresholds.pkl'
+
+    sol = {}
+    sol['thresholds'] = {}
+    sol['points'] = {}
+    for (row, label, threshold), br in sweep['brackets'].items():
+        tmp = {}
+        tmp['SNR'] = crossing(br, sweep['results'], row, label, threshold)
+        tmp['lo'] = br['lo']
+        tmp['hi'] = br['hi']
+        tmp['status'] = br['status']
+        d = sol['thresholds']
+        if len(row) > 0:
+            d = d.setdefault(summary_key(spec, row), {})
+        d.setdefault(label, {})[threshold] = tmp
+
+    # every point that was run, in the format of the summary files
+    for (row, SNR), tmp in sweep['results'].items():
+        d = sol['points']
+        if len(row) > 0:
+            d = d.setdefault(summary_key(spec, row), {})
+        d[SNR] = tmp
+
+    with open(outfile,'wb') as f:
+        pickle.dump(sol,f)
+
+def run_adaptive(specs, max_processes=None, data_processes=None):
+    sweeps = []
+    for spec in specs:
+        opts = adaptive_options(spec)
+        SNRs = grid_values(spec['SNR'])
+        lo, hi = snr_key(np.min(SNRs)), snr_key(np.max(SNRs))
+        brackets = {}
+        for row in itertools.product(*axis_grid(spec)):
+            for gas in spec['gases']:
+                for threshold in opts['thresholds']:
+                    brackets[(row, gas.upper(), float(threshold))] = new_bracket(lo, hi)
+        sweeps.append({'spec': spec, 'opts': opts, 'brackets': brackets, 'results': {}})
+
+    n = 0
+    while True:
+        # the points needed by the open brackets
+        tasks = []
+        points = []
+        for sweep in sweeps:
+            needed = set()
+            for (row, label, threshold), br in sweep['brackets'].items():
+                SNR = update_bracket(br, sweep['results'], row, label, threshold, sweep['opts']['tolerance'])
+                if SNR is not None:
+                    needed.add((row, SNR))
+            if n >= sweep['opts']['max_rounds']:
+                continue
+            for row, SNR in sorted(needed):
+                tasks.append(make_task(sweep['spec'], SNR, row))
+                points.append((sweep, row, SNR))
+        if len(tasks) == 0:
+            break
+
+        print('round '+'%i'%(n+1)+': '+'%i'%len(tasks)+' points')
+        run_tasks(specs, tasks, max_processes, data_processes)
+
+        for sweep, row, SNR in points:
+            try:
+                sweep['results'][(row, SNR)] = read_point(sweep['spec'], SNR, row)
+            except FileNotFoundError:
+                # retried in the next round
+                print('missing results for '+make_task(sweep['spec'], SNR, row)['filename'])
+        n += 1
+
+    for sweep in sweeps:
+        write_thresholds(sweep)
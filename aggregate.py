@@ -0,0 +1,199 @@
+import os
+import sys
+import argparse
+import pickle
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from sweep import load_spec, grid_values, axis_grid, point_root
+from detection import savage_dickey_lnB, detection_sigma
+from fileio import atomic_write
+
+# Sweep summaries as labelled N-D arrays, cheap enough to make every few
+# minutes while a sweep runs. Only outputs that are new or changed since
+# the last call (by mtime and size, or by their row of the evidence table
+# for a store) are read, in parallel; missing points are NaN. The forward
+# model is not imported.
+#
+# The result, <save_dir>/<name>_aggregate.pkl, is a dict with
+#   'dims'    axis names, the swept axes then 'SNR'
+#   'coords'  dict of axis name -> values
+#   'data'    dict of variable -> array with shape of the coords:
+#             logz_<label>, logzerr_<label> for each retrieval label,
+#             and lnB_X, sig_X and sig_lower_limit_X for each gas X. With
+#             detection: savage_dickey, they are the Savage-Dickey estimates
+#             and there are also sd_lnB_X, sd_sig_X and sd_lower_limit_X.
+#             The lower-limit flags are 1 where the value only bounds the
+#             Bayes factor and significance from below
+# Already read outputs are kept in <save_dir>/<name>_aggregate_cache.pkl.
+
+def retrieval_labels(spec):
+    labels = ['all']
+    if spec['detection'] != 'savage_dickey':
+        labels += ['no'+gas.upper() for gas in spec['gases']]
+    return labels
+
+def extract(results, label, rpars, gases):
+    # the entries of one retrieval output that are aggregated, with the
+    # Savage-Dickey estimates of gases from the full retrieval
+    out = {}
+    out['logz'] = float(results['logz'][-1])
+    out['logzerr'] = float(results['logzerr'][-1])
+    if label == 'all':
+        for gas in gases:
+            lnB, lower_limit = savage_dickey_lnB(results, rpars, gas)
+            out['sd_lnB_'+gas.upper()] = float(lnB)
+            out['sd_lower_limit_'+gas.upper()] = bool(lower_limit)
+    return out
+
+def read_pickle_output(filename, label, rpars, gases):
+    with open(filename,'rb') as f:
+        results = pickle.load(f)
+    return extract(results, label, rpars, gases)
+
+def read_store_output(store_file, name, label, rpars, gases):
+    import store
+    keys = ['logz', 'logzerr']
+    if label == 'all' and len(gases) > 0:
+        keys += ['logwt', 'samples_u']
+    return extract(store.read_results(store_file, name, label, keys), label, rpars, gases)
+
+def output_stamps(spec, roots):
+    # (root, label) -> (stamp, reader arguments) of every output there is
+    labels = retrieval_labels(spec)
+    stamps = {}
+
+    evidence = {}
+    if spec['store']:
+        import store
+        store_file = store.store_path(spec['save_dir'])
+        evidence = store.read_evidence(store_file)
+
+    for root in roots:
+        for label in labels:
+            name = os.path.basename(root)
+            if (name, label) in evidence:
+                row = evidence[(name, label)]
+                stamp = ('store', float(row['logz']), float(row['logzerr']))
+                stamps[(root, label)] = (stamp, (read_store_output, store_file, name))
+                continue
+            filename = root+'_'+label+'.pkl'
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                continue
+            stamps[(root, label)] = ((st.st_mtime, st.st_size), (read_pickle_output, filename))
+    return stamps
+
+# bumped when extract changes, so older cached entries are read again
+CACHE_VERSION = 3
+
+def cache_version(spec):
+    # entries depend on the detection method, as only Savage-Dickey needs
+    # the estimates from the full retrieval
+    return (CACHE_VERSION, spec['detection'])
+
+def load_cache(filename, version):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename,'rb') as f:
+        cache = pickle.load(f)
+    if cache.pop('version', None) != version:
+        return {}
+    return cache
+
+def save_pickle(filename, obj):
+    with atomic_write(filename) as f:
+        pickle.dump(obj, f)
+
+def aggregate(spec, processes=1):
+    dims = [axis['name'] for axis in spec['axes']] + ['SNR']
+    grids = axis_grid(spec) + [grid_values(spec['SNR'])]
+    shape = tuple(len(a) for a in grids)
+
+    roots = {}
+    for index in itertools.product(*[range(n) for n in shape]):
+        point = tuple(grids[k][index[k]] for k in range(len(spec['axes'])))
+        roots[index] = point_root(spec, grids[-1][index[-1]], point)
+
+    cache_file = spec['save_dir']+'/'+spec['name']+'_aggregate_cache.pkl'
+    cache = load_cache(cache_file, cache_version(spec))
+    stamps = output_stamps(spec, roots.values())
+
+    # read the new and changed outputs in parallel
+    sd_gases = spec['gases'] if spec['detection'] == 'savage_dickey' else []
+    outputs = {}
+    todo = []
+    for key, (stamp, reader) in stamps.items():
+        if key in cache and cache[key][0] == stamp:
+            outputs[key] = cache[key][1]
+        else:
+            todo.append((key, stamp, reader))
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = []
+            for key, stamp, reader in todo:
+                futures.append(pool.submit(reader[0], *reader[1:], key[1], spec['rpars'], sd_gases))
+            for (key, stamp, reader), future in zip(todo, futures):
+                try:
+                    outputs[key] = future.result()
+                except Exception as e:
+                    # e.g. a file being replaced while we read it
+                    print('could not read '+key[0]+' '+key[1]+': '+str(e))
+                    continue
+                cache[key] = (stamp, outputs[key])
+    cache['version'] = cache_version(spec)
+    save_pickle(cache_file, cache)
+
+    data = {}
+    def put(var, index, val):
+        if var not in data:
+            data[var] = np.full(shape, np.nan)
+        data[var][index] = val
+
+    for index, root in roots.items():
+        for label in retrieval_labels(spec):
+            out = outputs.get((root, label))
+            if out is None:
+                continue
+            put('logz_'+label, index, out['logz'])
+            put('logzerr_'+label, index, out['logzerr'])
+        out = outputs.get((root, 'all'))
+        if out is None:
+            continue
+        for gas in spec['gases']:
+            label = gas.upper()
+            if spec['detection'] == 'savage_dickey':
+                put('sd_lnB_'+label, index, out['sd_lnB_'+label])
+                put('sd_sig_'+label, index, detection_sigma(out['sd_lnB_'+label]))
+                put('sd_lower_limit_'+label, index, out['sd_lower_limit_'+label])
+                put('lnB_'+label, index, out['sd_lnB_'+label])
+                put('sig_lower_limit_'+label, index, out['sd_lower_limit_'+label])
+            elif (root, 'no'+label) in outputs:
+                put('lnB_'+label, index, out['logz'] - outputs[(root, 'no'+label)]['logz'])
+                put('sig_lower_limit_'+label, index, False)
+            else:
+                continue
+            put('sig_'+label, index, detection_sigma(data['lnB_'+label][index]))
+
+    sol = {}
+    sol['dims'] = dims
+    sol['coords'] = {dim: grid for dim, grid in zip(dims, grids)}
+    sol['data'] = data
+    save_pickle(spec['save_dir']+'/'+spec['name']+'_aggregate.pkl', sol)
+
+    ndone = int(np.sum(np.isfinite(data['logz_all']))) if 'logz_all' in data else 0
+    print(spec['name']+': '+'%i'%ndone+' of '+'%i'%len(roots)+' points, '+'%i'%len(todo)+' outputs read')
+    return sol
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Aggregate sweep results into labelled arrays.')
+    parser.add_argument('specs', nargs='+')
+    parser.add_argument('--processes', type=int, default=1)
+    args = parser.parse_args(argv)
+    for filename in args.specs:
+        aggregate(load_spec(filename), args.processes)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
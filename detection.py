@@ -0,0 +1,84 @@
+import numpy as np
+from scipy import special
+
+from priors import retrieved_parameters, gas_parameter
+
+# Bayes factors for removing a gas, estimated from the full retrieval
+# alone with the Savage-Dickey density ratio. Removing a gas is the
+# nested model with its mixing ratio at the lower edge of its flat prior
+# (e.g. fH2O = 1e-10 for a log-uniform prior on [1e-10, 1]), so
+#
+#   ln B(all vs. no gas) = ln prior(edge) - ln posterior(edge).
+#
+# We work in the unit cube of dynesty (samples_u), where a flat prior has
+# density 1 and the edge is u = 0, so only the posterior density at the
+# edge must be estimated. This is done from the posterior weight within
+# a width h of the edge, which is biased when the posterior density
+# changes over h; the two-retrieval evidence difference stays the
+# reference.
+#
+# With less than one effective sample within h of the edge, the density
+# is only bounded by 1/(ESS h), so ln B is capped at ln(ESS h): about 4.6,
+# or 3.5 sigma, for 2000 effective samples, and only 4.1 sigma for 20000.
+# Stronger detections are lower limits, and their significance needs the
+# two retrievals.
+
+EDGE_WIDTH = 0.05 # 0.5 dex for a prior spanning 10 dex
+
+def posterior_weights(results):
+    logwt = np.asarray(results['logwt'])
+    w = np.exp(logwt - logwt.max())
+    return w/np.sum(w)
+
+def gas_index(rpars, gas):
+    names = [par['name'] for par in retrieved_parameters(rpars)]
+    if gas_parameter(gas) not in names:
+        raise Exception(gas_parameter(gas)+' is not retrieved in '+rpars)
+    par = retrieved_parameters(rpars)[names.index(gas_parameter(gas))]
+    if par['gauss']:
+        raise Exception('Savage-Dickey estimate needs a flat prior on '+par['name'])
+    return names.index(gas_parameter(gas))
+
+def savage_dickey_lnB(results, rpars, gas, h=EDGE_WIDTH):
+    # Returns ln B and whether it is only a lower limit, which is the case
+    # when the posterior has less than one effective sample within h of
+    # the edge.
+    u = np.asarray(results['samples_u'])[:,gas_index(rpars, gas)]
+    w = posterior_weights(results)
+
+    # less than one effective sample near the edge only bounds the density
+    mass = np.sum(w[u < h])
+    ess = 1.0/np.sum(w**2)
+    lower_limit = mass < 1.0/ess
+    if lower_limit:
+        mass = 1.0/ess
+
+    density = mass/h
+    lnB = -np.log(density)
+    return lnB, lower_limit
+
+def detection_sigma(lnB):
+    # Significance of a Bayes factor following Benneke & Seager (2013),
+    # B = -1/(e p ln p) for the p-value p, as in rfast, but without
+    # importing the forward model. This bound on B only holds for
+    # p < 1/e, so every B <= 1 is given the 0.9 sigma of p = 1/e, and the
+    # significance is continuous in ln B. Unlike the lookup table of rfast
+    # it is not capped at large ln B.
+    lnB = float(lnB)
+    if np.isnan(lnB) or lnB == np.inf:
+        return lnB
+    # y = -ln p solves y - ln y = 1 + ln B with y >= 1, or with t = y - 1,
+    # t - ln(1 + t) = ln B, which keeps its precision near B = 1. Newton's
+    # method from above converges, as the left side is convex, and works in
+    # logarithms, so there is no overflow for large B.
+    lnB = max(lnB, 0.0)
+    t = 1.0 + 2.0*lnB
+    for i in range(200):
+        dt = (t - np.log1p(t) - lnB)*(1.0 + 1.0/t)
+        t -= dt
+        if dt <= 1e-14*t:
+            break
+    y = 1.0 + t
+    # p = erfc(sigma/sqrt(2)) = 2 Phi(-sigma), inverted with ln Phi so
+    # small p do not underflow
+    return float(-special.ndtri_exp(-y - np.log(2.0)))
@@ -0,0 +1,32 @@
+import os
+import fcntl
+import socket
+import contextlib
+
+# Writes and locks for files that several processes share, possibly on
+# several nodes with the same sweep directory (see workqueue.py).
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='wb'):
+    # Yields a file to write in place of filename, which is renamed over it
+    # once written, so readers never see a partial file. The temporary name
+    # is unique to the host and process, so concurrent writers of the same
+    # file never write into one temporary file.
+    tmp = filename+'.'+socket.gethostname()+'.%i.tmp'%os.getpid()
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, filename)
+    finally:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+
+@contextlib.contextmanager
+def file_lock(filename, shared=False):
+    # an flock on filename+'.lock', exclusive unless shared
+    with open(filename+'.lock','a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
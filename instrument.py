@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import contextlib
+
+# Per-stage timing of the pipeline. A stage is timed with
+#
+#   with instrument.stage('genspec_scr', template=...) as fields:
+#       ...
+#
+# which appends one JSON line to the log set with set_log, with the wall
+# and CPU time of the stage, the CPU time of child processes that ended
+# in it (e.g. a pool of likelihood workers), the peak RSS of the process
+# during the stage, any fields (which the stage can add to) and the
+# counters incremented with count() while the stage was open (e.g. calls
+# of the climate objective). Without a log, stages cost a function call.
+# Lines are appended with one write each, so processes can share a log.
+#
+# The peak RSS is the VmHWM of /proc/self/status, which is reset to the
+# current RSS at the start of every stage by writing 5 to
+# /proc/self/clear_refs. Enclosing stages keep the peaks of the stages
+# within them. Where that is not possible, it is the peak of the process
+# so far (ru_maxrss), and the record has 'maxrss_scope': 'process'.
+
+_LOG = {'file': None, 'context': {}}
+_OPEN = []
+
+def set_log(filename, **context):
+    # None turns logging off. context is added to every record.
+    _LOG['file'] = filename
+    _LOG['context'] = context
+
+def count(name, n=1):
+    for state in _OPEN:
+        state['counts'][name] = state['counts'].get(name, 0) + n
+
+def peak_rss():
+    # bytes, since the last reset_peak_rss, or None without /proc
+    try:
+        with open('/proc/self/status','r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def reset_peak_rss():
+    # whether the peak was reset
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def update_peaks():
+    # the stages that are open keep the peak so far, before it is reset
+    peak = peak_rss()
+    if peak is None:
+        return
+    for state in _OPEN:
+        state['peak'] = max(state['peak'], peak)
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    if _LOG['file'] is None:
+        yield fields
+        return
+
+    update_peaks()
+    state = {'counts': {}, 'peak': 0, 'reset': reset_peak_rss()}
+    _OPEN.append(state)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    cpu_children = children_cpu()
+    try:
+        yield fields
+    finally:
+        update_peaks()
+        _OPEN.remove(state)
+        record = {}
+        record['stage'] = name
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.process_time() - cpu
+        record['cpu_children'] = children_cpu() - cpu_children
+        if state['reset'] and state['peak'] > 0:
+            record['maxrss'] = state['peak']
+        else:
+            # kilobytes on Linux
+            record['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+            record['maxrss_scope'] = 'process'
+        record['pid'] = os.getpid()
+        record['time'] = time.time()
+        record.update(_LOG['context'])
+        record.update(fields)
+        record['counts'] = state['counts']
+        with open(_LOG['file'],'a') as f:
+            f.write(json.dumps(record, default=str)+'\n')
+
+def read_log(filename):
+    records = []
+    with open(filename,'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a killed process
+                continue
+    return records
+
+def breakdown(records):
+    # per stage: number of calls, total and mean wall time, total CPU
+    # time of the process and of its children, largest peak RSS and summed
+    # counters
+    stages = {}
+    for record in records:
+        s = stages.setdefault(record['stage'], {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'cpu_children': 0.0, 
+                                                'maxrss': 0, 'counts': {}})
+        s['n'] += 1
+        s['wall'] += record['wall']
+        s['cpu'] += record['cpu']
+        s['cpu_children'] += record.get('cpu_children', 0.0)
+        s['maxrss'] = max(s['maxrss'], record['maxrss'])
+        for key in record['counts']:
+            s['counts'][key] = s['counts'].get(key, 0) + record['counts'][key]
+    for s in stages.values():
+        s['mean_wall'] = s['wall']/s['n']
+    return stages
+
+def print_breakdown(stages):
+    total = sum(s['wall'] for s in stages.values())
+    fmt = "{:28}{:>8}{:>14}{:>12}{:>14}{:>16}{:>10}{:>10}  {}"
+    print(fmt.format('stage', 'calls', 'wall (h)', 'mean (s)', 'cpu (h)', 'child cpu (h)', 'wall %', 'RSS (MB)', 
+                     'counts'))
+    for name in sorted(stages, key=lambda a: -stages[a]['wall']):
+        s = stages[name]
+        counts = ', '.join(key+'='+'%i'%s['counts'][key] for key in sorted(s['counts']))
+        print(fmt.format(name, '%i'%s['n'], '%.3f'%(s['wall']/3600), '%.2f'%s['mean_wall'],
+                         '%.3f'%(s['cpu']/3600), '%.3f'%(s['cpu_children']/3600), 
+                         '%.1f'%(100*s['wall']/max(total, 1e-300)),
+                         '%.0f'%(s['maxrss']/1e6), counts))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per-stage breakdown of pipeline timing logs.')
+    parser.add_argument('logs', nargs='+')
+    args = parser.parse_args(argv)
+    records = []
+    for filename in args.logs:
+        records += read_log(filename)
+    print_breakdown(breakdown(records))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
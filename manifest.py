@@ -0,0 +1,93 @@
+import os
+import json
+import hashlib
+import contextlib
+
+from fileio import atomic_write, file_lock
+
+# Each sweep directory has a manifest.json recording, for every task, its
+# status and the size, mtime and checksum of the outputs that finished.
+# An output is only trusted if it matches its manifest entry, so files
+# left half-written by a killed run are redone. Outputs copied into the
+# HDF5 store of the sweep (see store.py) are trusted if the store has them,
+# and otherwise if their pickle is still there and unchanged.
+
+MANIFEST_NAME = 'manifest.json'
+
+def file_checksum(filename):
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def manifest_path(save_dir):
+    return os.path.join(save_dir, MANIFEST_NAME)
+
+def load_manifest(save_dir):
+    filename = manifest_path(save_dir)
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename,'r') as f:
+        return json.load(f)
+
+def save_manifest(save_dir, manifest):
+    with atomic_write(manifest_path(save_dir),'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+@contextlib.contextmanager
+def locked_manifest(save_dir):
+    # Load, change and save the manifest under a lock, for processes that
+    # share a sweep directory (e.g. work-queue workers)
+    with file_lock(manifest_path(save_dir)):
+        manifest = load_manifest(save_dir)
+        yield manifest
+        save_manifest(save_dir, manifest)
+
+def task_key(root):
+    return os.path.basename(root)
+
+def output_filename(root, label):
+    # e.g. label = 'data', 'all' or 'noH2O'
+    return root+'_'+label+'.pkl'
+
+def get_entry(manifest, root):
+    return manifest.setdefault(task_key(root), {'status': 'pending', 'outputs': {}})
+
+def output_valid(manifest, root, label):
+    filename = output_filename(root, label)
+    entry = manifest.get(task_key(root), {}).get('outputs', {}).get(label)
+    if entry is not None and 'store' in entry:
+        import store
+        if store.has_output(entry['store'], task_key(root), label):
+            return True
+    if entry is None or 'checksum' not in entry or not os.path.isfile(filename):
+        return False
+    st = os.stat(filename)
+    if st.st_size != entry['size']:
+        return False
+    if st.st_mtime == entry['mtime']:
+        return True
+    return file_checksum(filename) == entry['checksum']
+
+def record_output(manifest, root, label):
+    filename = output_filename(root, label)
+    st = os.stat(filename)
+    get_entry(manifest, root)['outputs'][label] = {
+        'path': filename,
+        'size': st.st_size,
+        'mtime': st.st_mtime,
+        'checksum': file_checksum(filename)
+    }
+
+def record_stored(manifest, root, label, store_filename):
+    # and the pickle, which is kept until the store is pruned
+    entry = get_entry(manifest, root)
+    entry['outputs'].pop(label, None)
+    if os.path.isfile(output_filename(root, label)):
+        record_output(manifest, root, label)
+    entry['outputs'].setdefault(label, {})['store'] = store_filename
+
+def set_status(manifest, root, status):
+    # 'pending', 'partial' (some outputs done) or 'done'
+    get_entry(manifest, root)['status'] = status
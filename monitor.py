@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import runtimes
+
+# A local HTTP endpoint for a running sweep (see scheduler.run_pipeline):
+#
+#   /metrics   Prometheus text format
+#   /status    the same as a JSON document
+#
+# The engine publishes a snapshot of its state whenever it changes: counts
+# of retrievals, the running retrievals, and the expected costs of those
+# left. Times, memory and sampler progress (from the .progress files the
+# retrievals write, see retrieval.ProgressWriter) are read when a request
+# comes in, so they are current even while the engine waits.
+
+def process_rss(pid):
+    # resident memory in bytes of a process and its children (e.g. its
+    # pool of likelihood workers), or None where /proc is not available
+    try:
+        with open('/proc/%i/statm'%pid,'r') as f:
+            rss = int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+    try:
+        with open('/proc/%i/task/%i/children'%(pid, pid),'r') as f:
+            children = [int(a) for a in f.read().split()]
+    except (OSError, ValueError):
+        children = []
+    for child in children:
+        rss += process_rss(child) or 0
+    return rss
+
+def read_progress(filename):
+    try:
+        with open(filename,'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def remaining_costs(snapshot, now):
+    # core-seconds left of each retrieval that is queued or running. A
+    # retrieval without an expected cost (no runtime history) is taken to
+    # cost the mean of those finished so far. None if there is neither.
+    finished = snapshot['finished_costs']
+    mean = sum(finished)/len(finished) if len(finished) > 0 else None
+    costs = []
+    for cost in snapshot['queued_costs']:
+        cost = cost if cost is not None else mean
+        if cost is None:
+            return None
+        costs.append(cost)
+    for job in snapshot['running']:
+        cost = job['expected'] if job['expected'] is not None else mean
+        if cost is None:
+            return None
+        costs.append(max(cost - (now - job['start'])*job['cores'], 0.0))
+    return costs
+
+class Monitor():
+
+    def __init__(self, max_processes, start=None):
+        self.max_processes = max_processes
+        self.start = time.time() if start is None else start
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.server = None
+
+    def publish(self, snapshot):
+        with self.lock:
+            self.snapshot = snapshot
+
+    def status(self):
+        with self.lock:
+            snapshot = self.snapshot
+        now = time.time()
+        sol = {}
+        sol['time'] = now
+        sol['elapsed'] = now - self.start
+        sol['max_processes'] = self.max_processes
+        if snapshot is None:
+            return sol
+
+        sol['retrievals'] = dict(snapshot['counts'])
+        sol['data'] = dict(snapshot['data'])
+        sol['cores_used'] = sum(job['cores'] for job in snapshot['running'])
+        sol['core_utilisation'] = sol['cores_used']/self.max_processes
+
+        running = []
+        for job in snapshot['running']:
+            tmp = {}
+            for key in ('point', 'label', 'SNR', 'pid', 'cores', 'expected'):
+                tmp[key] = job[key]
+            tmp['elapsed'] = now - job['start']
+            tmp['rss'] = process_rss(job['pid'])
+            tmp['progress'] = read_progress(job['progress'])
+            running.append(tmp)
+        sol['running'] = running
+
+        costs = remaining_costs(snapshot, now)
+        sol['projected_remaining'] = None
+        sol['projected_completion'] = None
+        if costs is not None:
+            sol['projected_remaining'] = runtimes.predict_makespan(costs, self.max_processes)
+            sol['projected_completion'] = now + sol['projected_remaining']
+        return sol
+
+    def metrics(self):
+        status = self.status()
+        lines = []
+        def metric(name, description, kind, samples):
+            lines.append('# HELP sweep_'+name+' '+description)
+            lines.append('# TYPE sweep_'+name+' '+kind)
+            for labels, val in samples:
+                if val is None:
+                    continue
+                lines.append('sweep_'+name+format_labels(labels)+' '+repr(float(val)))
+
+        metric('elapsed_seconds', 'Time since the sweep started.', 'gauge', [({}, status['elapsed'])])
+        metric('max_processes', 'Cores the sweep may use.', 'gauge', [({}, status['max_processes'])])
+        if 'retrievals' not in status:
+            return '\n'.join(lines)+'\n'
+
+        metric('retrievals', 'Retrievals by state.', 'gauge',
+               [({'state': key}, val) for key, val in sorted(status['retrievals'].items())])
+        metric('data_groups', 'Data generation jobs by state.', 'gauge',
+               [({'state': key}, val) for key, val in sorted(status['data'].items())])
+        metric('cores_used', 'Cores held by running retrievals.', 'gauge', [({}, status['cores_used'])])
+        metric('core_utilisation', 'Cores used as a fraction of max_processes.', 'gauge',
+               [({}, status['core_utilisation'])])
+        metric('projected_remaining_seconds', 'Projected wall time left.', 'gauge',
+               [({}, status['projected_remaining'])])
+        metric('projected_completion_timestamp_seconds', 'Projected end of the sweep.', 'gauge',
+               [({}, status['projected_completion'])])
+
+        def per_job(get):
+            samples = []
+            for job in status['running']:
+                labels = {'point': job['point'], 'label': job['label']}
+                try:
+                    samples.append((labels, get(job)))
+                except (KeyError, TypeError):
+                    continue
+            return samples
+        metric('retrieval_elapsed_seconds', 'Run time of a running retrieval.', 'gauge',
+               per_job(lambda job: job['elapsed']))
+        metric('retrieval_cores', 'Cores of a running retrieval.', 'gauge', per_job(lambda job: job['cores']))
+        metric('retrieval_rss_bytes', 'Resident memory of a retrieval and its workers.', 'gauge',
+               per_job(lambda job: job['rss']))
+        metric('retrieval_iterations', 'Nested sampling iterations.', 'gauge',
+               per_job(lambda job: job['progress']['iteration']))
+        metric('retrieval_likelihood_calls', 'Likelihood calls of a retrieval.', 'gauge',
+               per_job(lambda job: job['progress']['ncall']))
+        metric('retrieval_dlogz', 'Remaining evidence estimate, to be brought below the target.', 'gauge',
+               per_job(lambda job: job['progress']['dlogz']))
+        metric('retrieval_progress_age_seconds', 'Time since a retrieval last wrote its progress.', 'gauge',
+               per_job(lambda job: status['time'] - job['progress']['time']))
+        return '\n'.join(lines)+'\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        # Serve from a daemon thread until stop. The sweep runs on without
+        # the endpoint if the port can not be bound (e.g. it is taken by
+        # another sweep).
+        try:
+            self.server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print('not monitoring, could not serve on '+host+':'+'%i'%port+': '+str(e))
+            return
+        self.server.daemon_threads = True
+        self.server.monitor = self
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        print('monitoring on http://'+host+':'+'%i'%self.server.server_port+'/status and /metrics')
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    def escape(val):
+        return str(val).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+    return '{'+','.join(key+'="'+escape(labels[key])+'"' for key in sorted(labels))+'}'
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body = self.server.monitor.metrics().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif path == '/status':
+            body = json.dumps(self.server.monitor.status(), indent=1).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', '%i'%len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep requests out of the sweep output
+        pass
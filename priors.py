@@ -0,0 +1,31 @@
+# Reading the retrieval parameters and priors in an rfast rpars file
+
+def read_rpars(filename):
+    # Parameters in an rfast rpars file, in order
+    with open(filename,'r') as f:
+        lines = f.readlines()
+    pars = []
+    for line in lines[1:]:
+        cols = [a.strip() for a in line.split('|')]
+        if len(cols) < 7:
+            continue
+        par = {}
+        par['name'] = cols[0]
+        par['retrieved'] = cols[2] == 'y'
+        par['log'] = cols[3] == 'log'
+        par['gauss'] = cols[4] == 'g'
+        par['prior1'] = float(cols[5])
+        par['prior2'] = float(cols[6])
+        pars.append(par)
+    return pars
+
+def gas_parameter(gas):
+    # e.g. 'h2o' -> 'fH2O'
+    return 'f'+gas.upper()
+
+def retrieved_parameters(rpars, gas=None):
+    # retrieved parameters, without the gas if it is removed
+    pars = [par for par in read_rpars(rpars) if par['retrieved']]
+    if gas is not None:
+        pars = [par for par in pars if par['name'] != gas_parameter(gas)]
+    return pars
@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import pickle
+import signal
+import warnings
+import multiprocessing
+import dynesty
+
+from priors import retrieved_parameters
+from fileio import atomic_write
+import instrument
+
+# Nested-sampling retrievals run in their own process. By default they are
+# Rfast.nested_process, with the dynesty settings of rfast, so evidences
+# are comparable with earlier sweeps. With the sampler settings of a spec
+# given, run_nested drives dynesty directly with those settings, so the
+# sampler state can be checkpointed and resumed and the likelihood run in
+# a pool. Check such settings against rfast with compare_with_rfast first.
+# The likelihood and prior transform are module-level functions of
+# globals set in the child, so a checkpoint pickles references to them
+# and not the Rfast object.
+
+CHECKPOINT_EVERY = 600 # seconds
+
+# A running retrieval that gets SIGUSR1 checkpoints at the end of its
+# current iteration and exits with RESIZE_EXIT, so the scheduler can
+# resume it with more likelihood workers (see scheduler.run_pipeline).
+RESIZE_EXIT = 75
+_RESIZE = {'requested': False}
+
+class Resize(Exception):
+    pass
+
+def _request_resize(signum, frame):
+    _RESIZE['requested'] = True
+
+def request_resize(p):
+    os.kill(p.pid, signal.SIGUSR1)
+
+_r = None
+_dat = None
+_err = None
+
+def _loglike(x):
+    return _r.lnlike_nest(x, _dat, _err)
+
+def _prior_transform(u):
+    return _r.prior_transform(u)
+
+# Settings of the sampler that are arguments of run_nested. The others are
+# arguments of dynesty.NestedSampler (e.g. nlive, bound, sample).
+RUN_NESTED_KEYS = ('dlogz', 'maxiter', 'maxcall')
+
+def checkpoint_filename(outfile):
+    return outfile+'.checkpoint'
+
+# Running retrievals write their progress to <outfile>.progress, at most
+# every PROGRESS_EVERY seconds, for the sweep monitor (see monitor.py).
+PROGRESS_EVERY = 10 # seconds
+
+def progress_filename(outfile):
+    return outfile+'.progress'
+
+def write_progress(filename, progress):
+    progress['time'] = time.time()
+    progress['pid'] = os.getpid()
+    with atomic_write(filename,'w') as f:
+        json.dump(progress, f)
+
+class ProgressWriter():
+    # A dynesty print_func, called after every iteration. It also carries
+    # out resize requests, as the state of sampler is then the same as when
+    # dynesty checkpoints.
+
+    def __init__(self, filename, every=PROGRESS_EVERY):
+        self.filename = filename
+        self.every = every
+        self.last = 0.0
+        self.sampler = None
+        self.checkpoint_file = None
+
+    def __call__(self, results, niter, ncall, dlogz=None, **kwargs):
+        # not while the final live points are added
+        if _RESIZE['requested'] and self.sampler is not None and kwargs.get('add_live_it') is None:
+            self.sampler.save(self.checkpoint_file)
+            raise Resize()
+        now = time.time()
+        if now - self.last < self.every:
+            return
+        self.last = now
+        progress = {}
+        progress['phase'] = 'nested'
+        progress['iteration'] = int(niter)
+        progress['ncall'] = int(ncall)
+        progress['dlogz'] = float(min(results.delta_logz, 1e300))
+        progress['dlogz_target'] = None if dlogz is None else float(dlogz)
+        progress['logz'] = float(max(results.logz, -1e300))
+        write_progress(self.filename, progress)
+
+def run_nested(r, rpars, dat, err, outfile, gas=None, workers=1, checkpoint_every=CHECKPOINT_EVERY, 
+               **kwargs):
+    # Run a retrieval, resuming from its checkpoint if there is one. With
+    # workers > 1, live-point proposals are evaluated in parallel by a pool
+    # of that many processes. kwargs are the settings of the sampler (see
+    # RUN_NESTED_KEYS), which must be the same when resuming.
+    global _r, _dat, _err
+    _r = r
+    _dat = dat
+    _err = err
+
+    if gas is not None:
+        r.remove_gas(gas)
+
+    signal.signal(signal.SIGUSR1, _request_resize)
+
+    # the pool is forked after the globals are set and the gas is removed
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+
+    run_kwargs = {key: kwargs.pop(key) for key in RUN_NESTED_KEYS if key in kwargs}
+    checkpoint_file = checkpoint_filename(outfile)
+    progress = ProgressWriter(progress_filename(outfile))
+    progress.checkpoint_file = checkpoint_file
+    with instrument.stage('nested', outfile=os.path.basename(outfile), workers=workers) as fields:
+        resume = os.path.isfile(checkpoint_file)
+        fields['resumed'] = resume
+        if resume:
+            # The checkpoint may come from a run with another number of
+            # workers. The proposal queue is only refilled once empty, so
+            # its size can change between iterations.
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore', message='Restoring the sampler with the original queue_size')
+                sampler = dynesty.NestedSampler.restore(checkpoint_file, pool=pool)
+            sampler.queue_size = workers
+        else:
+            ndim = len(retrieved_parameters(rpars, gas))
+            if pool is not None:
+                kwargs['pool'] = pool
+                kwargs['queue_size'] = workers
+            sampler = dynesty.NestedSampler(_loglike, _prior_transform, ndim, **kwargs)
+        progress.sampler = sampler
+        try:
+            sampler.run_nested(resume=resume, checkpoint_file=checkpoint_file, 
+                               checkpoint_every=checkpoint_every, print_func=progress, **run_kwargs)
+        except Resize:
+            fields['resized'] = True
+        # likelihood calls, including those made in the pool and before
+        # a resume
+        fields['ncall'] = int(sampler.ncall)
+
+        # joined within the stage, so it has the CPU time of the pool
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if fields.get('resized', False):
+        sys.exit(RESIZE_EXIT)
+
+    with atomic_write(outfile) as f:
+        pickle.dump(sampler.results, f)
+    for filename in (checkpoint_file, progress_filename(outfile)):
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+def rfast_process(r, dat, err, outfile, gas=None):
+    # Rfast.nested_process, which starts the retrieval in a process of its
+    # own. It can not be checkpointed, resized or given workers.
+    n0 = len(r.retrieval_processes)
+    if gas is not None:
+        r.remove_gas(gas)
+    r.nested_process(dat, err, outfile)
+    if gas is not None:
+        r.undo_remove_gas()
+    return r.retrieval_processes[n0]['process']
+
+def nested_process(r, rpars, dat, err, outfile, gas=None, workers=1, sampler=None):
+    # With sampler None the retrieval is rfast's own, otherwise run_nested
+    # with those settings. The gas is removed in the child, so r is
+    # unchanged in the parent.
+    if sampler is None:
+        return rfast_process(r, dat, err, outfile, gas)
+    p = multiprocessing.Process(target=run_nested, args=(r, rpars, dat, err, outfile, gas, workers), 
+                                kwargs=sampler)
+    p.start()
+    return p
+
+def compare_with_rfast(r, rpars, dat, err, outfile, workers=1, **kwargs):
+    # Runs one retrieval with Rfast.nested_process and with run_nested and
+    # the settings kwargs, to outfile+'_rfast.pkl' and outfile+'_sampler.pkl'.
+    # Returns (logz, logzerr) of each.
+    processes = {}
+    processes['rfast'] = rfast_process(r, dat, err, outfile+'_rfast.pkl')
+    processes['sampler'] = nested_process(r, rpars, dat, err, outfile+'_sampler.pkl', workers=workers, 
+                                          sampler=kwargs)
+    sol = {}
+    for name in processes:
+        processes[name].join()
+        with open(outfile+'_'+name+'.pkl','rb') as f:
+            results = pickle.load(f)
+        sol[name] = (float(results['logz'][-1]), float(results['logzerr'][-1]))
+    return sol
@@ -0,0 +1,102 @@
+import os
+import json
+import heapq
+import contextlib
+import numpy as np
+
+from fileio import atomic_write, file_lock
+
+# Runtime history of retrievals and a log-linear model of their cost, used
+# to launch the longest retrievals first and to predict the cost of a
+# sweep before it starts.
+#
+# A record is {'experiment', 'label' ('all', 'noH2O', ...), 'SNR',
+# 'params' (the other swept values, e.g. T_surf), 'seconds' (wall time),
+# 'workers'}. Costs are in core-seconds, seconds*workers. The model is
+#
+#   ln(cost) = a + b*ln(SNR) + sum_k c_k*params_k
+#
+# fitted per (experiment, label). Without enough records for that, the
+# fit falls back to ln(SNR) only, over the label and then over all records.
+
+def load_history(filename):
+    if filename is None or not os.path.isfile(filename):
+        return []
+    with open(filename,'r') as f:
+        return json.load(f)
+
+def save_history(filename, history):
+    with atomic_write(filename,'w') as f:
+        json.dump(history, f)
+
+@contextlib.contextmanager
+def locked_history(filename):
+    # Load, change and save the history under a lock, as sweeps running at
+    # the same time share it
+    with file_lock(filename):
+        history = load_history(filename)
+        yield history
+        save_history(filename, history)
+
+def task_params(task):
+    return {k: float(task['info'][k]) for k in task['info'] if k != 'SNR'}
+
+def make_record(task, label, seconds, workers):
+    record = {}
+    record['experiment'] = task.get('experiment')
+    record['label'] = label
+    record['SNR'] = task['SNR']
+    record['params'] = task_params(task)
+    record['seconds'] = seconds
+    record['workers'] = workers
+    return record
+
+def features(SNR, params, names):
+    return [1.0, np.log(SNR)] + [params[k] for k in names]
+
+def fit(records, names):
+    # least squares fit of ln(cost), or None if there are too few records
+    if len(records) < len(names) + 2:
+        return None
+    x = np.array([features(a['SNR'], a['params'], names) for a in records])
+    y = np.log([a['seconds']*a['workers'] for a in records])
+    coeffs = np.linalg.lstsq(x, y, rcond=None)[0]
+    return coeffs
+
+class RuntimeModel():
+
+    def __init__(self, history):
+        self.history = history
+        self.fits = {}
+
+    def get_fit(self, key, records, names):
+        if key not in self.fits:
+            self.fits[key] = fit(records, names)
+        return self.fits[key]
+
+    def predict(self, experiment, label, SNR, params):
+        # predicted cost in core-seconds, or None without any history
+        names = sorted(params)
+        records = [a for a in self.history if a['experiment'] == experiment and a['label'] == label
+                   and sorted(a['params']) == names]
+        candidates = [
+            (('exp', experiment, label, tuple(names)), records, names),
+            (('exp', experiment, label), records, []),
+            (('label', label), [a for a in self.history if a['label'] == label], []),
+            (('all',), self.history, [])
+        ]
+        for key, records, names in candidates:
+            coeffs = self.get_fit(key, records, names)
+            if coeffs is not None:
+                return float(np.exp(np.dot(coeffs, features(SNR, params, names))))
+        if len(self.history) > 0:
+            return float(np.exp(np.mean(np.log([a['seconds']*a['workers'] for a in self.history]))))
+        return None
+
+def predict_makespan(costs, nslots):
+    # wall time of running jobs of the given costs, longest first, on
+    # nslots cores with one core each
+    slots = [0.0]*min(nslots, max(len(costs), 1))
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(slots, heapq.heappop(slots) + cost)
+    return max(slots)
@@ -0,0 +1,522 @@
+import os
+import gc
+import time
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import connection, Pipe
+
+from rfast import Rfast
+
+import utils
+import manifest
+import retrieval
+import store
+import runtimes
+import instrument
+import monitor
+from fileio import atomic_write
+
+# A task is a dict describing one retrieval grid point:
+#   'filename'   root of the output files
+#   'model'      'temperature' or 'hz' (see utils.make_spectra)
+#   'atmosphere' arguments for utils.make_spectra
+#   'template'   rfast template used to make the data. Tasks with the
+#                same atmosphere and different templates (bands) share
+#                one climate calculation.
+#   'clima'      settings for utils.make_climate
+#   'climate_cache' directory of cached climate states, or None
+#   'rpars'      retrieval parameter file
+#   'SNR', 'FpFs_err'
+#   'gases'      gases removed, one at a time, for the null retrievals
+#   'detection'  'two_run' (a null retrieval per gas) or 'savage_dickey'
+#                (Bayes factors from the full retrieval only)
+#   'info'       extra entries saved to the _data.pkl file
+#   'experiment' name of the sweep, for the runtime history (optional)
+#   'store'      keep data and results in the HDF5 store of the sweep
+#                directory instead of pickle files (optional, see store.py)
+#   'instrument' file that per-stage timings are appended to, or None
+#                (optional, see instrument.py)
+#   'sampler'    settings of dynesty, e.g. nlive and dlogz, or None for
+#                those of Rfast.nested_process (optional, see retrieval.py)
+
+# One retrieval instance per (template, rpars), in the parent process
+_RETRIEVAL_POOL = {}
+
+def get_retrieval(template, rpars):
+    key = (template, rpars)
+    if key not in _RETRIEVAL_POOL:
+        with instrument.stage('Rfast', template=template, rpars=rpars):
+            r = Rfast(template)
+            r.initialize_retrieval(rpars)
+        utils.share_rfast_arrays(r, template, rpars)
+        _RETRIEVAL_POOL[key] = r
+    return _RETRIEVAL_POOL[key]
+
+def retrieval_units(task):
+    # (output label, gas removed) for each retrieval of a task
+    units = [('all', None)]
+    if task.get('detection', 'two_run') == 'savage_dickey':
+        return units
+    for gas in task['gases']:
+        units.append(('no'+gas.upper(), gas))
+    return units
+
+def print_progress(nr, nc, nt, start):
+    tot_time = (time.time()-start)/60
+    fmt = "{:20}"
+    print(fmt.format("running: "+'%i'%nr)+\
+    fmt.format('completed: ''%i'%nc)+\
+    fmt.format('total: ''%i'%nt)+\
+    "{:30}".format('time: ''%.2f'%tot_time+' min'),end='\n')
+
+def group_tasks(tasks):
+    # Tasks that only differ in SNR or template (band) share an atmosphere,
+    # so they are made by the same data worker.
+    groups = []
+    index = {}
+    for i,task in enumerate(tasks):
+        key = json.dumps([task['model'], task['atmosphere'], task['clima'], 
+                          task['climate_cache'], task['FpFs_err'], task.get('instrument')], sort_keys=True)
+        if key not in index:
+            index[key] = len(groups)
+            group = {}
+            group['model'] = task['model']
+            group['atmosphere'] = task['atmosphere']
+            group['clima'] = task['clima']
+            group['climate_cache'] = task['climate_cache']
+            group['FpFs_err'] = task['FpFs_err']
+            group['instrument'] = task.get('instrument')
+            group['templates'] = []
+            group['SNRs'] = []
+            group['tasks'] = []
+            groups.append(group)
+        groups[index[key]]['templates'].append(task['template'])
+        groups[index[key]]['SNRs'].append(task['SNR'])
+        groups[index[key]]['tasks'].append(i)
+    return groups
+
+def generate_data(model, atmosphere, clima, climate_cache, FpFs_err, templates, SNRs, instrument_log=None):
+    # Runs in a data worker, which keeps its own AdiabatClimate.
+    # Returns (lam, dlam, dat, err) for each (template, SNR).
+    instrument.set_log(instrument_log, model=model)
+    c = utils.get_climate(clima)
+    bands = list(dict.fromkeys(templates))
+    spectra = dict(zip(bands, utils.make_spectra(c, model, bands, atmosphere, climate_cache)))
+    data = []
+    for template, SNR in zip(templates, SNRs):
+        r, F2 = spectra[template]
+        dat, err = utils.make_data_from_spectrum(r, F2, SNR, FpFs_err)
+        data.append((r.lam, r.dlam, dat, err))
+    return data
+
+def task_store(task):
+    # the HDF5 store of the task, or None for pickle files
+    if not task.get('store', False):
+        return None
+    return store.store_path(os.path.dirname(task['filename']))
+
+def save_data(task, lam, dlam, dat, err):
+    if task_store(task) is not None:
+        store.write_data(task_store(task), store.point_name(task['filename']), lam, dlam, dat, err, 
+                         task['info'])
+        return
+    sol = {}
+    sol['lam'] = lam
+    sol['dlam'] = dlam
+    sol['dat'] = dat
+    sol['err'] = err
+    for key in task['info']:
+        sol[key] = task['info'][key]
+    with atomic_write(manifest.output_filename(task['filename'], 'data')) as fil:
+        pickle.dump(sol, fil)
+
+def load_data(task):
+    name = store.point_name(task['filename'])
+    if task_store(task) is not None and store.has_output(task_store(task), name, 'data'):
+        sol = store.read_data(task_store(task), name)
+        return sol['dat'], sol['err']
+    with open(manifest.output_filename(task['filename'], 'data'),'rb') as fil:
+        sol = pickle.load(fil)
+    return sol['dat'], sol['err']
+
+def record_output(m, task, label):
+    # Records a finished output in the manifest m. With a store, retrieval
+    # outputs are copied into it.
+    if task_store(task) is None:
+        manifest.record_output(m, task['filename'], label)
+        return
+    if label != 'data':
+        store.ingest_results(task_store(task), store.point_name(task['filename']), label,
+                             manifest.output_filename(task['filename'], label), task['info'])
+    manifest.record_stored(m, task['filename'], label, task_store(task))
+
+def recover_output(m, task, label):
+    # Records an output that has no entry in the manifest m but exists and
+    # loads, e.g. of a retrieval that finished after the engine that ran
+    # it was killed. Returns whether it was recorded.
+    if label in m.get(manifest.task_key(task['filename']), {}).get('outputs', {}):
+        return False
+    if task_store(task) is not None and store.has_output(task_store(task), store.point_name(task['filename']), label):
+        manifest.record_stored(m, task['filename'], label, task_store(task))
+        return True
+    filename = manifest.output_filename(task['filename'], label)
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with open(filename,'rb') as fil:
+            sol = pickle.load(fil)
+        complete = ('dat' if label == 'data' else 'logz') in sol.keys()
+    except Exception:
+        complete = False
+    if not complete:
+        return False
+    record_output(m, task, label)
+    return True
+
+def spawn_retrieval(task, dat, err, units, workers=1):
+    # Returns the retrieval processes that were launched, one per unit.
+    # With sampler settings, each retrieval checkpoints its sampler and
+    # resumes from the checkpoint if the task is rescheduled.
+
+    r = get_retrieval(task['template'], task['rpars'])
+
+    processes = []
+    for label, gas in units:
+        outfile = manifest.output_filename(task['filename'], label)
+        # the child keeps the log it is forked with
+        instrument.set_log(task.get('instrument'), point=store.point_name(task['filename']), label=label,
+                           SNR=task['SNR'])
+        p = retrieval.nested_process(r, task['rpars'], dat, err, outfile, gas, workers, task.get('sampler'))
+        processes.append(p)
+    instrument.set_log(None)
+
+    return processes
+
+# Upper limit on the likelihood workers of one retrieval. dynesty proposes
+# queue_size points from the same bound, so more workers help less and less.
+MAX_WORKERS = 8
+# Retrievals younger than this are not resized
+RESIZE_MIN_AGE = 60 # seconds
+
+def run_pipeline(tasks, max_processes, data_processes=1, queue_size=None, opacity_cache=None,
+                 max_workers=MAX_WORKERS, history=None, monitor_port=None):
+    # Data are made by a pool of data_processes workers and put in a
+    # bounded queue of at most queue_size data sets (made or being made).
+    # Retrievals are launched as soon as data are ready and enough slots
+    # are free. We block on the retrieval process
+    # sentinels and on a pipe that is written to when data are done.
+    #
+    # Finished outputs are recorded in the manifest of each sweep
+    # directory. On a rerun, tasks whose outputs are all valid are skipped,
+    # valid data are reused, and only missing retrievals are launched.
+    #
+    # With opacity_cache set, the large arrays of the retrieval instances
+    # are memory-mapped from that directory (see utils.share_rfast_arrays),
+    # so all retrievals share one copy. The Rfast that data workers build
+    # for each atmosphere is not shared.
+    #
+    # max_processes counts cores, not retrievals, and includes the data
+    # workers that are running. While more retrievals wait than there are
+    # free cores each gets one, but at the end of a sweep the free cores
+    # are shared out among the last retrievals as workers for their
+    # likelihood evaluations (up to max_workers each). Once nothing is left
+    # to launch, cores that free up go to running retrievals: they
+    # checkpoint and are resumed with at least twice as many workers (see
+    # retrieval.RESIZE_EXIT). Only retrievals with sampler settings get
+    # workers, as those of rfast run on one core.
+    #
+    # Retrievals are launched longest-expected first. The expected cost
+    # comes from a model fitted to the runtime history in the file history
+    # (see runtimes.py), which is extended as retrievals finish. Without a
+    # history, the highest SNRs are launched first.
+    #
+    # With monitor_port, the state of the sweep is served on that local
+    # port as Prometheus metrics and JSON (see monitor.py).
+
+    utils.set_opacity_cache(opacity_cache)
+
+    if queue_size is None:
+        queue_size = max(max_processes//2, 1)
+
+    start = time.time()
+
+    manifests = {}
+    for task in tasks:
+        save_dir = os.path.dirname(task['filename'])
+        if save_dir not in manifests:
+            manifests[save_dir] = manifest.load_manifest(save_dir)
+    def task_manifest(task):
+        return manifests[os.path.dirname(task['filename'])]
+    def save_task_manifest(task):
+        save_dir = os.path.dirname(task['filename'])
+        manifest.save_manifest(save_dir, manifests[save_dir])
+
+    # work out what is left to do
+    todo = {}
+    ready = []
+    need_data = []
+    nskipped = 0
+    nrecovered = 0
+    for i,task in enumerate(tasks):
+        m = task_manifest(task)
+        for label in ['data'] + [u[0] for u in retrieval_units(task)]:
+            if recover_output(m, task, label):
+                nrecovered += 1
+        units = [u for u in retrieval_units(task) if not manifest.output_valid(m, task['filename'], u[0])]
+        if len(units) == 0:
+            manifest.set_status(m, task['filename'], 'done')
+            nskipped += 1
+            continue
+        if len(units) > max_processes:
+            raise Exception('max_processes must be at least '+'%i'%len(units))
+        # build the retrieval instances before forking any workers
+        instrument.set_log(task.get('instrument'))
+        get_retrieval(task['template'], task['rpars'])
+        instrument.set_log(None)
+        todo[i] = units
+        if manifest.output_valid(m, task['filename'], 'data'):
+            dat, err = load_data(task)
+            ready.append((i, dat, err))
+        else:
+            need_data.append(i)
+    if nrecovered > 0:
+        print('%i'%nrecovered+' finished outputs were not in the manifests and have been recorded')
+        for save_dir in manifests:
+            manifest.save_manifest(save_dir, manifests[save_dir])
+    if nskipped > 0:
+        print('%i'%nskipped+' tasks are already complete')
+    # while data are made, a task must fit next to the data workers
+    if len(need_data) > 0 and max(len(todo[i]) for i in need_data) > max_processes - data_processes:
+        raise Exception('max_processes must be at least data_processes + '+\
+                        '%i'%max(len(todo[i]) for i in need_data))
+
+    # expected cost of every retrieval left to do
+    history_records = runtimes.load_history(history)
+    model = runtimes.RuntimeModel(history_records)
+    unit_costs = {}
+    for i in todo:
+        params = runtimes.task_params(tasks[i])
+        unit_costs[i] = [model.predict(tasks[i].get('experiment'), label, tasks[i]['SNR'], params) 
+                         for label, gas in todo[i]]
+    def expected_cost(i):
+        if len(history_records) == 0:
+            return tasks[i]['SNR']
+        return sum(unit_costs[i])
+    def sort_ready():
+        ready.sort(key=lambda item: -expected_cost(item[0]))
+
+    if len(history_records) > 0 and len(todo) > 0:
+        costs = [cost for i in todo for cost in unit_costs[i]]
+        print('predicted cost: '+'%.1f'%(sum(costs)/3600)+' core-hours, '+\
+              '%.1f'%(runtimes.predict_makespan(costs, max_processes)/3600)+' hours')
+    sort_ready()
+
+    # objects made so far are never freed, so keep the garbage collector
+    # from touching (and so copying) their pages in the forked children
+    gc.freeze()
+
+    groups = group_tasks([tasks[i] for i in need_data])
+    for group in groups:
+        group['tasks'] = [need_data[j] for j in group['tasks']]
+    groups.sort(key=lambda g: -max(expected_cost(i) for i in g['tasks']))
+
+    reader, writer = Pipe(duplex=False)
+    def notify(future):
+        writer.send(None)
+
+    nt = sum(len(units) for units in todo.values())
+    ig = 0
+    pending = {}
+    processes = []
+    launched = {}
+    cores = {}
+    starts = {}
+    nfailed = 0
+    ndone = 0
+    finished_costs = []
+    task_data = {}
+    # retrievals asked to resize -> their new number of workers, and the
+    # units to resume with it
+    resizable = set()
+    resizing = {}
+    relaunch = []
+
+    mon = None
+    if monitor_port is not None:
+        mon = monitor.Monitor(max_processes, start)
+        mon.serve(monitor_port)
+    def snapshot():
+        queued = [i for i, _, _ in ready] + [i for g in list(pending.values()) + groups[ig:] for i in g['tasks']]
+        sol = {}
+        sol['counts'] = {'queued': nt - ndone - nfailed - len(launched), 'running': len(launched), 
+                         'done': ndone, 'failed': nfailed}
+        sol['data'] = {'running': len(pending), 'waiting': len(groups) - ig}
+        sol['queued_costs'] = [cost for i in queued for cost in unit_costs[i]]
+        sol['finished_costs'] = list(finished_costs)
+        sol['running'] = []
+        for p, (i, label) in launched.items():
+            outfile = manifest.output_filename(tasks[i]['filename'], label)
+            job = {}
+            job['point'] = store.point_name(tasks[i]['filename'])
+            job['label'] = label
+            job['SNR'] = tasks[i]['SNR']
+            job['pid'] = p.pid
+            job['cores'] = cores[p]
+            job['start'] = starts[p][0]
+            job['expected'] = unit_costs[i][[u[0] for u in todo[i]].index(label)]
+            job['progress'] = retrieval.progress_filename(outfile)
+            sol['running'].append(job)
+        return sol
+
+    state = None
+
+    with ProcessPoolExecutor(max_workers=data_processes) as pool:
+        while True:
+
+            while reader.poll():
+                reader.recv()
+
+            # collect finished data
+            for future in [f for f in pending if f.done()]:
+                group = pending.pop(future)
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print('data generation failed for '+tasks[group['tasks'][0]]['filename']+': '+str(e))
+                    nfailed += sum(len(todo[i]) for i in group['tasks'])
+                    continue
+                for i, (lam, dlam, dat, err) in zip(group['tasks'], data):
+                    save_data(tasks[i], lam, dlam, dat, err)
+                    record_output(task_manifest(tasks[i]), tasks[i], 'data')
+                    save_task_manifest(tasks[i])
+                    ready.append((i, dat, err))
+                sort_ready()
+
+            # record finished retrievals
+            for p in [p for p in launched if not p.is_alive()]:
+                i, label = launched.pop(p)
+                resizable.discard(p)
+                if p in resizing and p.exitcode == retrieval.RESIZE_EXIT:
+                    unit = [u for u in todo[i] if u[0] == label][0]
+                    relaunch.append((i, unit, resizing.pop(p)))
+                    processes.remove(p)
+                    continue
+                resizing.pop(p, None)
+                task = tasks[i]
+                m = task_manifest(task)
+                if p.exitcode == 0 and os.path.isfile(manifest.output_filename(task['filename'], label)):
+                    record_output(m, task, label)
+                    ndone += 1
+                    # retrievals that were resumed did not run in full
+                    t0, partial = starts[p]
+                    if not partial:
+                        finished_costs.append((time.time()-t0)*cores[p])
+                    if history is not None and not partial:
+                        with runtimes.locked_history(history) as records:
+                            records.append(runtimes.make_record(task, label, time.time()-t0, cores[p]))
+                else:
+                    print('retrieval failed: '+manifest.output_filename(task['filename'], label))
+                    nfailed += 1
+                done = all(manifest.output_valid(m, task['filename'], u[0]) for u in retrieval_units(task))
+                manifest.set_status(m, task['filename'], 'done' if done else 'partial')
+                save_task_manifest(task)
+
+            # resume resized retrievals, on the cores kept for them
+            for i, unit, workers in relaunch:
+                dat, err = task_data[i]
+                p = spawn_retrieval(tasks[i], dat, err, [unit], workers)[0]
+                launched[p] = (i, unit[0])
+                cores[p] = workers
+                starts[p] = (time.time(), True)
+                resizable.add(p)
+                processes.append(p)
+            relaunch = []
+
+            # fill every free retrieval slot
+            while True:
+                running = [p for p in processes if p.is_alive()]
+                used = sum(cores[p] for p in running)
+                # cores of the data workers that are busy
+                used += min(data_processes, len(pending))
+                if len(ready) > 0 and used + len(todo[ready[0][0]]) <= max_processes:
+                    # retrievals that still have to be launched, this one included
+                    nwaiting = sum(len(todo[j]) for j, _, _ in ready)
+                    nwaiting += sum(len(todo[j]) for g in pending.values() for j in g['tasks'])
+                    nwaiting += sum(len(todo[j]) for g in groups[ig:] for j in g['tasks'])
+                    workers = min(max(1, (max_processes - used)//nwaiting), max_workers)
+
+                    i, dat, err = ready.pop(0)
+                    # the retrievals of rfast run on one core
+                    if tasks[i].get('sampler') is None:
+                        workers = 1
+                    partial = [os.path.isfile(retrieval.checkpoint_filename(
+                               manifest.output_filename(tasks[i]['filename'], label))) for label, gas in todo[i]]
+                    new = spawn_retrieval(tasks[i], dat, err, todo[i], workers)
+                    task_data[i] = (dat, err)
+                    for p, (label, gas), part in zip(new, todo[i], partial):
+                        launched[p] = (i, label)
+                        cores[p] = workers
+                        starts[p] = (time.time(), part)
+                        if tasks[i].get('sampler') is not None:
+                            resizable.add(p)
+                    processes += new
+                else:
+                    break
+
+            # at the tail, share the free cores out among the running
+            # retrievals with the fewest workers
+            timeout = None
+            if len(ready) == 0 and len(pending) == 0 and ig == len(groups):
+                free = max_processes - sum(cores[p] for p in launched)
+                now = time.time()
+                candidates = [p for p in resizable if p not in resizing and cores[p] < max_workers]
+                young = [starts[p][0] + RESIZE_MIN_AGE - now for p in candidates 
+                         if now - starts[p][0] <= RESIZE_MIN_AGE]
+                if free > 0 and len(young) > 0:
+                    # come back when they are old enough
+                    timeout = min(young) + 1.0
+                candidates = [p for p in candidates if now - starts[p][0] > RESIZE_MIN_AGE]
+                candidates.sort(key=lambda p: cores[p])
+                for k, p in enumerate(candidates):
+                    extra = free//len(candidates) + (1 if k < free % len(candidates) else 0)
+                    workers = min(cores[p] + extra, max_workers)
+                    if workers >= 2*cores[p]:
+                        retrieval.request_resize(p)
+                        resizing[p] = workers
+                        cores[p] = workers
+
+            # keep the data workers ahead of the retrievals
+            nqueued = len(ready) + sum(len(g['tasks']) for g in pending.values())
+            while ig < len(groups) and nqueued < queue_size:
+                group = groups[ig]
+                future = pool.submit(generate_data, group['model'], group['atmosphere'], group['clima'], 
+                                     group['climate_cache'], group['FpFs_err'], group['templates'], 
+                                     group['SNRs'], group['instrument'])
+                pending[future] = group
+                future.add_done_callback(notify)
+                nqueued += len(group['tasks'])
+                ig+=1
+
+            nr = len(running)
+            nc = len(processes) - nr
+
+            # print progress when something changed
+            if (nr, nc, nfailed) != state:
+                print_progress(nr, nc, nt, start)
+                state = (nr, nc, nfailed)
+
+            if mon is not None:
+                mon.publish(snapshot())
+
+            if nr == 0 and len(launched) == 0 and len(ready) == 0 and len(pending) == 0 and ig == len(groups):
+                break
+
+            # finished but unrecorded retrievals make this return at once
+            connection.wait([p.sentinel for p in launched] + [reader], timeout)
+
+    if mon is not None:
+        mon.stop()
+
+    if nfailed > 0:
+        print('%i'%nfailed+' retrievals failed or were not run; rerun the sweep to retry them')
@@ -0,0 +1,132 @@
+import pickle
+import numpy as np
+from scipy import optimize
+from concurrent.futures import ProcessPoolExecutor
+
+from priors import retrieved_parameters, gas_parameter
+from sweep import expand_tasks, summary_key
+
+# Cheap detection significances for every point of a sweep, to find where
+# the full retrievals are needed. For each point we find the maximum
+# likelihood with all parameters and with the gas removed, and use
+#
+#   sig = sqrt(2*(lnL_all - lnL_no)),
+#
+# the likelihood-ratio (Wilks) significance for one parameter on the edge
+# of its prior. Fits are done in the unit cube of the priors, from several
+# starting points.
+#
+# The data have no noise, so when the error bars only change by a factor
+# between SNRs, the best fits are the same and the chi-squared difference
+# scales with that factor squared. Each atmosphere is then fitted once, at
+# its lowest SNR.
+
+STARTS = 8
+
+def fit_max_likelihood(r, dat, err, ndim, starts=STARTS, u0s=None, seed=0):
+    # returns the best lnL and unit-cube point
+    def fun(u):
+        lnL = r.lnlike_nest(r.prior_transform(u), dat, err)
+        if not np.isfinite(lnL):
+            return 1e100
+        return -lnL
+
+    rng = np.random.default_rng(seed)
+    u0s = [] if u0s is None else list(u0s)
+    u0s += list(rng.uniform(0.0, 1.0, (starts, ndim)))
+
+    best = None
+    for u0 in u0s:
+        sol = optimize.minimize(fun, u0, method='Powell', bounds=[(0.0, 1.0)]*ndim)
+        if best is None or sol.fun < best.fun:
+            best = sol
+    return -best.fun, best.x
+
+def screen_fits(r, rpars, dat, err, gases, starts=STARTS):
+    # lnL of the best fit with all parameters and without each gas
+    names = [par['name'] for par in retrieved_parameters(rpars)]
+    lnL = {}
+    lnL['all'], u_all = fit_max_likelihood(r, dat, err, len(names), starts)
+    for gas in gases:
+        # also start from the best fit with the gas taken out
+        u0 = np.delete(u_all, names.index(gas_parameter(gas)))
+        r.remove_gas(gas)
+        try:
+            lnL['no'+gas.upper()], u = fit_max_likelihood(r, dat, err, len(names)-1, starts, [u0])
+        finally:
+            r.undo_remove_gas()
+    return lnL
+
+def screen_group(group, rpars, gases, starts=STARTS):
+    # Runs in a worker. Returns the summary entry of each task of a group
+    # of tasks that share an atmosphere (see scheduler.group_tasks).
+    import scheduler
+
+    data = scheduler.generate_data(group['model'], group['atmosphere'], group['clima'],
+                                   group['climate_cache'], group['FpFs_err'], group['templates'],
+                                   group['SNRs'])
+
+    fits = {}
+    entries = []
+    for template, SNR, (lam, dlam, dat, err) in zip(group['templates'], group['SNRs'], data):
+        r = scheduler.get_retrieval(template, rpars)
+
+        # reuse a fit of the same template if the error bars only differ
+        # by a factor
+        scale = None
+        if template in fits:
+            dat0, err0, lnL0 = fits[template]
+            ratio = err0/err
+            if np.allclose(dat, dat0) and np.allclose(ratio, ratio[0]):
+                scale = ratio[0]**2
+        if scale is None:
+            fits[template] = (dat, err, screen_fits(r, rpars, dat, err, gases, starts))
+            dat0, err0, lnL0 = fits[template]
+            scale = 1.0
+
+        tmp = {}
+        tmp['data'] = {'lam': lam, 'dlam': dlam, 'dat': dat, 'err': err}
+        for gas in gases:
+            label = gas.upper()
+            dchi2 = 2.0*(lnL0['all'] - lnL0['no'+label])*scale
+            tmp['dchi2_'+label] = dchi2
+            tmp['sig_'+label] = np.sqrt(max(dchi2, 0.0))
+        entries.append(tmp)
+    return entries
+
+def write_screen(spec, processes=1, outfile=None, starts=STARTS):
+    import scheduler
+
+    if outfile is None:
+        outfile = spec['save_dir']+'/'+spec['name']+'_screen.pkl'
+
+    tasks = expand_tasks(spec)
+    groups = scheduler.group_tasks(tasks)
+    # lowest SNR first, so the other SNRs reuse its fit
+    for group in groups:
+        order = np.argsort(group['SNRs'])
+        for key in ['templates', 'SNRs', 'tasks']:
+            group[key] = [group[key][k] for k in order]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(screen_group, group, spec['rpars'], spec['gases'], starts) for group in groups]
+        entries = {}
+        for group, future in zip(groups, futures):
+            for i, tmp in zip(group['tasks'], future.result()):
+                entries[i] = tmp
+
+    # same layout as the summary of the full retrievals
+    sol = {}
+    for i, task in enumerate(tasks):
+        point = tuple(task['info'][axis['name']] for axis in spec['axes'])
+        ss = task['info']['SNR']
+        tmp = entries[i]
+        for key in task['info']:
+            tmp['data'][key] = task['info'][key]
+        if len(point) > 0:
+            sol.setdefault(summary_key(spec, point), {})[ss] = tmp
+        else:
+            sol[ss] = tmp
+
+    with open(outfile,'wb') as f:
+        pickle.dump(sol,f)
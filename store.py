@@ -0,0 +1,230 @@
+import os
+import sys
+import argparse
+import pickle
+import hashlib
+import contextlib
+import numpy as np
+import h5py
+
+from fileio import file_lock
+
+# One HDF5 file per sweep directory holds the data and retrieval results
+# of every point, in place of the _data.pkl, _all.pkl and _noX.pkl files:
+#
+#   /grids/<hash>/lam, dlam     wavelength grids, stored once
+#   /points/<name>/data         dat, err; attrs: grid and the task info
+#   /points/<name>/<label>      numeric arrays of the dynesty results
+#                               (chunked, compressed); attrs: scalars
+#   /evidence                   table of name, label, logz, logzerr and
+#                               the task info of every retrieval
+#
+# An HDF5 file can not be written by several processes at once, so every
+# access holds a lock on a lock file next to the store, exclusive for
+# writes. Retrievals still write their output pickle, which the parent
+# copies into the store when the retrieval finishes. Entries are marked
+# complete only once fully written and read back.
+#
+# The store is a single file without a journal, so a crash while it is
+# written can lose every point in it. The pickles are therefore kept as
+# well, and outputs fall back to them. Once the store is backed up,
+#
+#   python store.py prune <save_dir>
+#
+# removes the pickles whose results the store holds unchanged.
+
+STORE_NAME = 'results.h5'
+
+def store_path(save_dir):
+    return os.path.join(save_dir, STORE_NAME)
+
+@contextlib.contextmanager
+def open_store(filename, mode='r'):
+    with file_lock(filename, shared=(mode == 'r')):
+        with h5py.File(filename, mode) as f:
+            yield f
+
+def point_name(root):
+    # same as the manifest key
+    return os.path.basename(root)
+
+def has_output(filename, name, label):
+    if not os.path.isfile(filename):
+        return False
+    try:
+        with open_store(filename) as f:
+            path = 'points/'+name+'/'+label
+            return path in f and f[path].attrs.get('complete', False)
+    except OSError as e:
+        # a damaged store, whose outputs are taken from the pickles
+        print('could not read '+filename+': '+str(e))
+        return False
+
+def new_group(f, path):
+    if path in f:
+        del f[path]
+    return f.create_group(path)
+
+def write_data(filename, name, lam, dlam, dat, err, info):
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(lam, dtype=float).tobytes())
+    h.update(np.ascontiguousarray(dlam, dtype=float).tobytes())
+    grid = h.hexdigest()[:16]
+
+    with open_store(filename,'a') as f:
+        if 'grids/'+grid not in f:
+            g = f.create_group('grids/'+grid)
+            g['lam'] = lam
+            g['dlam'] = dlam
+        g = new_group(f, 'points/'+name+'/data')
+        g['dat'] = dat
+        g['err'] = err
+        g.attrs['grid'] = grid
+        for key in info:
+            g.attrs[key] = info[key]
+        g.attrs['complete'] = True
+
+def read_data(filename, name):
+    # a dict like the _data.pkl files
+    with open_store(filename) as f:
+        g = f['points/'+name+'/data']
+        sol = {}
+        sol['lam'] = f['grids/'+g.attrs['grid']+'/lam'][:]
+        sol['dlam'] = f['grids/'+g.attrs['grid']+'/dlam'][:]
+        sol['dat'] = g['dat'][:]
+        sol['err'] = g['err'][:]
+        for key in g.attrs:
+            if key not in ('grid', 'complete'):
+                sol[key] = g.attrs[key]
+    return sol
+
+def write_results(filename, name, label, results, info):
+    # the numeric arrays and scalars of dynesty results; other entries
+    # (bounds, proposal statistics) are not kept
+    with open_store(filename,'a') as f:
+        g = new_group(f, 'points/'+name+'/'+label)
+        for key, val in results.items():
+            if val is None:
+                continue
+            try:
+                a = np.asarray(val)
+            except ValueError:
+                continue
+            if a.dtype.kind not in 'biuf':
+                continue
+            if a.ndim == 0:
+                g.attrs[key] = a
+            else:
+                g.create_dataset(key, data=a, chunks=True, compression='gzip', shuffle=True)
+        logz = float(results['logz'][-1])
+        logzerr = float(results['logzerr'][-1])
+        g.attrs['complete'] = True
+        append_evidence(f, name, label, logz, logzerr, info)
+
+def read_results(filename, name, label, keys=None):
+    # a dict of the stored results, or of only the given keys
+    with open_store(filename) as f:
+        g = f['points/'+name+'/'+label]
+        results = {}
+        for key in g:
+            if keys is None or key in keys:
+                results[key] = g[key][:]
+        for key in g.attrs:
+            if key != 'complete' and (keys is None or key in keys):
+                results[key] = g.attrs[key]
+    return results
+
+def same_results(filename, name, label, results):
+    # whether the store holds the numeric entries of results unchanged
+    stored = read_results(filename, name, label)
+    for key, val in results.items():
+        if key not in stored:
+            continue
+        if not np.array_equal(np.asarray(stored[key]), np.asarray(val), equal_nan=True):
+            return False
+    return 'logz' in stored
+
+def ingest_results(filename, name, label, outfile, info):
+    # copies a retrieval output pickle into the store, which keeps the
+    # pickle until prune
+    with open(outfile,'rb') as f:
+        results = pickle.load(f)
+    write_results(filename, name, label, results, info)
+    if not same_results(filename, name, label, results):
+        raise Exception('Results of '+name+' '+label+' were not stored correctly in '+filename)
+
+def prune(save_dir):
+    # removes the output pickles of save_dir that the store holds unchanged
+    filename = store_path(save_dir)
+    with open_store(filename) as f:
+        stored = []
+        for name in f.get('points', {}):
+            for label in f['points/'+name]:
+                if label != 'data' and f['points/'+name+'/'+label].attrs.get('complete', False):
+                    stored.append((name, label))
+    n = 0
+    for name, label in stored:
+        outfile = os.path.join(save_dir, name+'_'+label+'.pkl')
+        if not os.path.isfile(outfile):
+            continue
+        with open(outfile,'rb') as f:
+            results = pickle.load(f)
+        if not same_results(filename, name, label, results):
+            print('keeping '+outfile+', which differs from the store')
+            continue
+        os.remove(outfile)
+        n += 1
+    print('removed '+'%i'%n+' output pickles of '+filename)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the HDF5 result store of a sweep.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    sub = subparsers.add_parser('prune', help='Remove output pickles held unchanged by the store.')
+    sub.add_argument('save_dir')
+    args = parser.parse_args(argv)
+    if args.command == 'prune':
+        prune(args.save_dir)
+
+def append_evidence(f, name, label, logz, logzerr, info):
+    # the columns of the task info are fixed by the first row
+    keys = sorted(info)
+    if 'evidence' not in f:
+        dtype = [('name', 'S128'), ('label', 'S32'), ('logz', 'f8'), ('logzerr', 'f8')]
+        dtype += [(key, 'f8') for key in keys]
+        f.create_dataset('evidence', shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+    table = f['evidence']
+    if sorted(table.dtype.names[4:]) != keys:
+        raise Exception('Task info does not match the evidence table of the store.')
+
+    row = np.zeros(1, dtype=table.dtype)
+    row['name'] = name
+    row['label'] = label
+    row['logz'] = logz
+    row['logzerr'] = logzerr
+    for key in keys:
+        row[key] = info[key]
+
+    # a rerun replaces its row
+    rows = table[:]
+    match = np.nonzero((rows['name'] == name.encode()) & (rows['label'] == label.encode()))[0]
+    if len(match) > 0:
+        table[match[0]] = row[0]
+    else:
+        table.resize((table.shape[0]+1,))
+        table[-1] = row[0]
+
+def read_evidence(filename):
+    # the evidence table as a dict (name, label) -> row
+    if not os.path.isfile(filename):
+        return {}
+    with open_store(filename) as f:
+        if 'evidence' not in f:
+            return {}
+        rows = f['evidence'][:]
+    table = {}
+    for row in rows:
+        table[(row['name'].decode(), row['label'].decode())] = row
+    return table
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,328 @@
+import os
+import sys
+import argparse
+import itertools
+import pickle
+import numpy as np
+from ruamel.yaml import YAML
+
+# A sweep spec (see input/sweeps/) gives the rfast template and retrieval
+# parameters, clima settings, the model and atmosphere used to make the
+# data, the gases to test, the SNR grid, and the axes to sweep. Every
+# (SNR, axis values) point becomes one task for the execution engine in
+# scheduler.py. This module does not import the forward model, so specs
+# can be read without it.
+
+def load_spec(filename):
+    yaml = YAML(typ='safe')
+    with open(filename,'r') as f:
+        spec = yaml.load(f)
+    spec.setdefault('axes', [])
+    spec.setdefault('detection', 'two_run')
+    spec.setdefault('climate_cache', None)
+    spec.setdefault('opacity_cache', None)
+    spec.setdefault('runtime_history', None)
+    spec.setdefault('store', False)
+    spec.setdefault('instrument', False)
+    spec.setdefault('monitor_port', None)
+    spec.setdefault('sampler', None)
+    if spec['detection'] not in ('two_run', 'savage_dickey'):
+        raise Exception('Unknown detection method: '+spec['detection'])
+    for axis in spec['axes']:
+        axis.setdefault('target', axis['name'])
+    return spec
+
+def grid_values(values):
+    # a list of values, or {start, stop, step, scale} for np.arange
+    if isinstance(values, dict):
+        return np.arange(values['start'], values['stop'], values['step'])*values.get('scale', 1.0)
+    return np.array(values, dtype=float)
+
+def set_target(atmosphere, target, value):
+    # target is a key of atmosphere, or key.species for compositions
+    keys = target.split('.')
+    d = atmosphere
+    for key in keys[:-1]:
+        d = d[key]
+    if keys[-1] not in d:
+        raise Exception('Sweep target '+target+' is not in the atmosphere.')
+    d[keys[-1]] = float(value)
+
+def copy_atmosphere(atmosphere):
+    new = {}
+    for key in atmosphere:
+        if isinstance(atmosphere[key], dict):
+            new[key] = dict(atmosphere[key])
+        else:
+            new[key] = atmosphere[key]
+    return new
+
+def point_filename(spec, T_surf, SNR, point):
+    filename = 'Ts='+('%.5f'%(T_surf))+'_SNR='+('%.5f'%(SNR))
+    for axis, val in zip(spec['axes'], point):
+        if axis['name'] != 'T_surf':
+            filename += '_'+axis['name']+'='+('%.5e'%(val))
+    return spec['save_dir'] + '/' + filename
+
+def axis_grid(spec):
+    return [grid_values(axis['values']) for axis in spec['axes']]
+
+def instrument_filename(spec):
+    # per-stage timings of the sweep (see instrument.py)
+    return spec['save_dir']+'/'+spec['name']+'_instrument.jsonl'
+
+def make_task(spec, SNR, point):
+    # the task for one (SNR, axis values) point
+    atmosphere = copy_atmosphere(spec['atmosphere'])
+    for axis, val in zip(spec['axes'], point):
+        set_target(atmosphere, axis['target'], val)
+
+    info = {}
+    info['T_surf'] = atmosphere['T_surf']
+    info['SNR'] = SNR
+    for axis, val in zip(spec['axes'], point):
+        info[axis['name']] = val
+
+    task = {}
+    task['filename'] = point_filename(spec, atmosphere['T_surf'], SNR, point)
+    task['model'] = spec['model']
+    task['atmosphere'] = atmosphere
+    task['template'] = spec['template']
+    task['clima'] = spec['clima']
+    task['climate_cache'] = spec['climate_cache']
+    task['rpars'] = spec['rpars']
+    task['SNR'] = float(SNR)
+    task['FpFs_err'] = spec['FpFs_err']
+    task['gases'] = spec['gases']
+    task['detection'] = spec['detection']
+    task['info'] = info
+    task['experiment'] = spec['name']
+    task['store'] = spec['store']
+    task['instrument'] = instrument_filename(spec) if spec['instrument'] else None
+    task['sampler'] = None if spec['sampler'] is None else dict(spec['sampler'])
+    return task
+
+def expand_tasks(spec):
+    SNRs = grid_values(spec['SNR'])
+    tasks = []
+    for SNR in SNRs:
+        for point in itertools.product(*axis_grid(spec)):
+            tasks.append(make_task(spec, SNR, point))
+    return tasks
+
+def run_option(specs, key):
+    # options that are per run rather than per sweep; the first one given
+    # is used
+    for spec in specs:
+        if spec[key] is not None:
+            return spec[key]
+    return None
+
+def run_tasks(specs, tasks, max_processes=None, data_processes=None):
+    # run tasks of the given specs with one engine
+    import scheduler
+
+    for spec in specs:
+        if not os.path.isdir(spec['save_dir']):
+            raise Exception(spec['save_dir']+' must exist!')
+
+    if max_processes is None:
+        max_processes = max(spec['max_processes'] for spec in specs)
+    if data_processes is None:
+        data_processes = max(spec.get('data_processes', 1) for spec in specs)
+    opacity_cache = run_option(specs, 'opacity_cache')
+    history = run_option(specs, 'runtime_history')
+    monitor_port = run_option(specs, 'monitor_port')
+
+    # points that appear more than once are only run once
+    unique = []
+    filenames = set()
+    for task in tasks:
+        if task['filename'] not in filenames:
+            filenames.add(task['filename'])
+            unique.append(task)
+
+    scheduler.run_pipeline(unique, max_processes, data_processes, opacity_cache=opacity_cache, 
+                           history=history, monitor_port=monitor_port)
+
+def run_sweeps(specs, max_processes=None, data_processes=None):
+    # all sweeps share one engine
+    tasks = []
+    for spec in specs:
+        tasks += expand_tasks(spec)
+    run_tasks(specs, tasks, max_processes, data_processes)
+
+def summary_key(spec, point):
+    if len(point) == 1:
+        return point[0]
+    return tuple(point)
+
+def load_output(spec, filename, label, keys=None):
+    # An output of a point, from the store of the sweep or its pickle
+    # file. keys limits what is read of retrieval results in the store.
+    if spec['store']:
+        import store
+        path = store.store_path(spec['save_dir'])
+        name = store.point_name(filename)
+        if store.has_output(path, name, label):
+            if label == 'data':
+                return store.read_data(path, name)
+            return store.read_results(path, name, label, keys)
+    with open(filename+'_'+label+'.pkl','rb') as f:
+        return pickle.load(f)
+
+def point_root(spec, SNR, point):
+    # root of the output files of a point
+    atmosphere = copy_atmosphere(spec['atmosphere'])
+    for axis, val in zip(spec['axes'], point):
+        set_target(atmosphere, axis['target'], val)
+    return point_filename(spec, atmosphere['T_surf'], SNR, point)
+
+def read_point(spec, SNR, point):
+    # summary entry of one finished point
+    from detection import savage_dickey_lnB, detection_sigma
+
+    filename = point_root(spec, SNR, point)
+
+    tmp = {}
+    tmp['data'] = load_output(spec, filename, 'data')
+
+    keys = ['logz']
+    if spec['detection'] == 'savage_dickey':
+        keys += ['logwt', 'samples_u']
+    results = load_output(spec, filename, 'all', keys)
+    tmp['all_evidence'] = results['logz'][-1]
+
+    for gas in spec['gases']:
+        label = gas.upper()
+
+        # sig_lower_limit_X says sig_X only bounds the significance
+        tmp['sig_lower_limit_'+label] = False
+        if spec['detection'] == 'savage_dickey':
+            # Savage-Dickey estimate from the full retrieval
+            lnB, lower_limit = savage_dickey_lnB(results, spec['rpars'], gas)
+            tmp['sd_lnB_'+label] = lnB
+            tmp['sd_lower_limit_'+label] = lower_limit
+            tmp['sd_sig_'+label] = detection_sigma(lnB)
+            tmp['sig_'+label] = tmp['sd_sig_'+label]
+            tmp['sig_lower_limit_'+label] = lower_limit
+            continue
+
+        null_results = load_output(spec, filename, 'no'+label, ['logz'])
+        tmp['no'+label+'_evidence'] = null_results['logz'][-1]
+
+        # detection significance
+        lnB = tmp['all_evidence'] - tmp['no'+label+'_evidence']
+        tmp['sig_'+label] = detection_sigma(lnB)
+
+    return tmp
+
+def write_summary(spec, outfile=None):
+    if outfile is None:
+        outfile = spec['save_dir']+'/'+spec['name']+'_summary.pkl'
+
+    SNRs = grid_values(spec['SNR'])
+    sol = {}
+    for point in itertools.product(*axis_grid(spec)):
+        if len(point) > 0:
+            sol[summary_key(spec, point)] = {}
+        for ss in SNRs:
+            tmp = read_point(spec, ss, point)
+            if len(point) > 0:
+                sol[summary_key(spec, point)][ss] = tmp
+            else:
+                sol[ss] = tmp
+
+    with open(outfile,'wb') as f:
+        pickle.dump(sol,f)
+
+def write_stages(spec, outfile=None):
+    # per-stage breakdown of the timings of the sweep
+    import instrument
+
+    if outfile is None:
+        outfile = spec['save_dir']+'/'+spec['name']+'_stages.pkl'
+
+    stages = instrument.breakdown(instrument.read_log(instrument_filename(spec)))
+    print(spec['name']+':')
+    instrument.print_breakdown(stages)
+
+    with open(outfile,'wb') as f:
+        pickle.dump(stages,f)
+
+def check_sampler(spec, workers=1):
+    # Runs the full retrieval of the first point of the sweep with
+    # Rfast.nested_process and with the sampler settings of the spec, to
+    # <save_dir>/<name>_check_*.pkl, and prints both evidences
+    import scheduler
+    import retrieval
+
+    if spec['sampler'] is None:
+        raise Exception(spec['name']+' has no sampler settings to check.')
+    task = expand_tasks(spec)[0]
+    lam, dlam, dat, err = scheduler.generate_data(task['model'], task['atmosphere'], task['clima'], 
+                                                  task['climate_cache'], task['FpFs_err'], 
+                                                  [task['template']], [task['SNR']])[0]
+    r = scheduler.get_retrieval(task['template'], task['rpars'])
+    outfile = spec['save_dir']+'/'+spec['name']+'_check'
+    sol = retrieval.compare_with_rfast(r, task['rpars'], dat, err, outfile, workers, **spec['sampler'])
+
+    print(spec['name']+': '+os.path.basename(task['filename']))
+    for name in sol:
+        print('{:10}'.format(name)+'ln Z = '+'%.3f'%sol[name][0]+' +/- '+'%.3f'%sol[name][1])
+    diff = sol['sampler'][0] - sol['rfast'][0]
+    print('difference: '+'%.3f'%diff+' ('+'%.1f'%(abs(diff)/np.hypot(sol['sampler'][1], sol['rfast'][1]))+' sigma)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run or summarize retrieval sweeps.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='run one or more sweeps with a shared engine')
+    p.add_argument('specs', nargs='+')
+    p.add_argument('--max-processes', type=int, default=None)
+    p.add_argument('--data-processes', type=int, default=None)
+
+    p = sub.add_parser('summary', help='write the summary pickle of each sweep')
+    p.add_argument('specs', nargs='+')
+
+    p = sub.add_parser('stages', help='write and print the per-stage timing breakdown of each sweep')
+    p.add_argument('specs', nargs='+')
+
+    p = sub.add_parser('screen', help='write approximate significances from maximum-likelihood fits')
+    p.add_argument('specs', nargs='+')
+    p.add_argument('--processes', type=int, default=1)
+
+    p = sub.add_parser('adaptive', help='find the detection thresholds of sweeps by bisection in SNR')
+    p.add_argument('specs', nargs='+')
+    p.add_argument('--max-processes', type=int, default=None)
+    p.add_argument('--data-processes', type=int, default=None)
+
+    p = sub.add_parser('check-sampler', help='compare a retrieval with the sampler settings of each sweep '+\
+                                             'to one with those of rfast')
+    p.add_argument('specs', nargs='+')
+    p.add_argument('--workers', type=int, default=1)
+
+    args = parser.parse_args(argv)
+    specs = [load_spec(a) for a in args.specs]
+
+    if args.command == 'run':
+        run_sweeps(specs, args.max_processes, args.data_processes)
+    elif args.command == 'summary':
+        for spec in specs:
+            write_summary(spec)
+    elif args.command == 'stages':
+        for spec in specs:
+            write_stages(spec)
+    elif args.command == 'screen':
+        import screening
+        for spec in specs:
+            screening.write_screen(spec, args.processes)
+    elif args.command == 'adaptive':
+        import adaptive
+        adaptive.run_adaptive(specs, args.max_processes, args.data_processes)
+    elif args.command == 'check-sampler':
+        for spec in specs:
+            check_sampler(spec, args.workers)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,38 @@
+import pytest
+
+import adaptive
+
+def run_bisection(sigma, lo, hi, threshold, tolerance=0.05):
+    # brackets the crossing of sigma(SNR), running points as asked
+    results = {}
+    br = adaptive.new_bracket(lo, hi)
+    while True:
+        SNR = adaptive.update_bracket(br, results, (), 'H2O', threshold, tolerance)
+        if SNR is None:
+            return br, results
+        results[((), SNR)] = {'sig_H2O': sigma(SNR)}
+
+def test_bisection_finds_the_crossing():
+    br, results = run_bisection(lambda SNR: SNR/2, 1.0, 100.0, 5.0)
+    assert br['status'] == 'resolved'
+    assert br['lo'] <= 10.0 <= br['hi']
+    assert br['hi']/br['lo'] - 1 < 0.05
+    assert adaptive.crossing(br, results, (), 'H2O', 5.0) == pytest.approx(10.0, rel=1e-3)
+    # far fewer points than a grid of that resolution
+    assert len(results) < 15
+
+def test_crossing_outside_the_range():
+    br, results = run_bisection(lambda SNR: 10.0, 1.0, 100.0, 5.0)
+    assert br['status'] == 'below'
+    br, results = run_bisection(lambda SNR: 1.0, 1.0, 100.0, 5.0)
+    assert br['status'] == 'above'
+    assert adaptive.crossing(br, results, (), 'H2O', 5.0) is None
+
+def test_lower_limit_can_not_place_a_higher_threshold():
+    results = {((), 1.0): {'sig_H2O': 1.0}, ((), 10.0): {'sig_H2O': 3.6, 'sig_lower_limit_H2O': True}}
+    # a lower limit above the threshold still places it
+    br = adaptive.new_bracket(1.0, 10.0)
+    assert adaptive.update_bracket(br, results, (), 'H2O', 3.0, 0.05) is not None
+    br = adaptive.new_bracket(1.0, 10.0)
+    with pytest.raises(Exception, match='lower limit'):
+        adaptive.update_bracket(br, results, (), 'H2O', 5.0, 0.05)
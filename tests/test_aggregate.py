@@ -0,0 +1,83 @@
+import os
+import pickle
+import numpy as np
+import pytest
+
+import aggregate
+from detection import detection_sigma
+
+RPARS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'input', 'rpars.txt')
+
+def make_spec(save_dir, detection):
+    spec = {}
+    spec['name'] = 'test'
+    spec['save_dir'] = str(save_dir)
+    spec['rpars'] = RPARS
+    spec['atmosphere'] = {'T_surf': 288.0}
+    spec['axes'] = [{'name': 'T_surf', 'target': 'T_surf', 'values': [280.0, 290.0]}]
+    spec['SNR'] = [5.0, 10.0]
+    spec['gases'] = ['h2o']
+    spec['detection'] = detection
+    spec['store'] = False
+    return spec
+
+def write_output(spec, T_surf, SNR, label, results):
+    root = aggregate.point_root(spec, SNR, (T_surf,))
+    with open(root+'_'+label+'.pkl','wb') as f:
+        pickle.dump(results, f)
+
+def test_two_run(tmp_path):
+    spec = make_spec(tmp_path, 'two_run')
+    # results without posterior samples, as only the evidences are read
+    write_output(spec, 280.0, 10.0, 'all', {'logz': [-5.0, 4.0], 'logzerr': [0.1, 0.2]})
+    write_output(spec, 280.0, 10.0, 'noH2O', {'logz': [-5.0, 1.0], 'logzerr': [0.1, 0.3]})
+    write_output(spec, 290.0, 5.0, 'all', {'logz': [2.0], 'logzerr': [0.1]})
+
+    sol = aggregate.aggregate(spec)
+    assert sol['dims'] == ['T_surf', 'SNR']
+    data = sol['data']
+    assert data['logz_all'][0,1] == 4.0
+    assert data['logzerr_noH2O'][0,1] == 0.3
+    assert data['lnB_H2O'][0,1] == 3.0
+    assert data['sig_H2O'][0,1] == pytest.approx(detection_sigma(3.0))
+    assert data['sig_lower_limit_H2O'][0,1] == 0
+    # missing points are NaN, including a point without its null retrieval
+    assert np.isnan(data['logz_all'][0,0])
+    assert data['logz_all'][1,0] == 2.0
+    assert np.isnan(data['lnB_H2O'][1,0])
+    assert 'sd_lnB_H2O' not in data
+
+def test_only_new_outputs_are_read(tmp_path, capsys):
+    spec = make_spec(tmp_path, 'two_run')
+    write_output(spec, 280.0, 5.0, 'all', {'logz': [1.0], 'logzerr': [0.1]})
+    aggregate.aggregate(spec)
+    assert '1 outputs read' in capsys.readouterr().out
+
+    write_output(spec, 290.0, 5.0, 'all', {'logz': [2.0], 'logzerr': [0.1]})
+    sol = aggregate.aggregate(spec)
+    assert '1 outputs read' in capsys.readouterr().out
+    assert sol['data']['logz_all'][0,0] == 1.0
+    assert sol['data']['logz_all'][1,0] == 2.0
+
+    # a replaced output is read again
+    write_output(spec, 280.0, 5.0, 'all', {'logz': [3.0, 1.5], 'logzerr': [0.1, 0.1]})
+    sol = aggregate.aggregate(spec)
+    assert '1 outputs read' in capsys.readouterr().out
+    assert sol['data']['logz_all'][0,0] == 1.5
+
+def test_savage_dickey(tmp_path):
+    from priors import retrieved_parameters, gas_parameter
+    spec = make_spec(tmp_path, 'savage_dickey')
+    names = [par['name'] for par in retrieved_parameters(RPARS)]
+    n = 100000
+    samples_u = np.full((n, len(names)), 0.5)
+    # a posterior equal to the prior, so B = 1
+    samples_u[:,names.index(gas_parameter('h2o'))] = (np.arange(n) + 0.5)/n
+    write_output(spec, 280.0, 5.0, 'all', {'logz': [1.0], 'logzerr': [0.1], 'logwt': np.zeros(n), 
+                                           'samples_u': samples_u})
+
+    data = aggregate.aggregate(spec)['data']
+    assert data['lnB_H2O'][0,0] == pytest.approx(0.0, abs=0.01)
+    assert data['sd_lnB_H2O'][0,0] == data['lnB_H2O'][0,0]
+    assert data['sig_lower_limit_H2O'][0,0] == 0
+    assert 'logz_noH2O' not in data
@@ -0,0 +1,52 @@
+import types
+import numpy as np
+import pytest
+
+pytest.importorskip('rfast')
+pytest.importorskip('clima')
+import utils
+
+class ToySolver(utils.StableClimateSolver):
+    # A well-conditioned system with the units of the climate one, and
+    # noise on f in place of that of clima's iterative radiative transfer
+
+    def __init__(self, noise, seed, **kwargs):
+        super().__init__(types.SimpleNamespace(T_trop=200.0), **kwargs)
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def objective(self, x, N_i, distance_au, T_surf):
+        key = tuple(np.asarray(x, dtype=float))
+        if key not in self._memo:
+            self.ncalls += 1
+            a = key[0] - N_i
+            b = key[1] - np.log10(T_surf)
+            f = np.array([100.0*a + 10.0*a**2 + 20.0*b, 5.0*a + 300.0*b])
+            self._memo[key] = f + self.noise*self.rng.standard_normal(2)
+        return self._memo[key]
+
+    def set_state(self, x, N_i, distance_au, T_surf):
+        pass
+
+@pytest.mark.parametrize('seed', range(10))
+def test_solve_converges_with_noise(seed):
+    solver = ToySolver(1.0e-6, seed)
+    root = np.array([1.0, np.log10(200.0)])
+    x = solver.solve(1.0, 1.0, 200.0, root + [0.3, -0.05])
+    f = solver.objective(x, 1.0, 1.0, 200.0)
+    assert np.all(np.abs(f) <= solver.ftol)
+    assert np.allclose(x, root, atol=1e-4)
+    assert solver.ncalls < 20
+
+def test_jacobian_is_reused():
+    solver = ToySolver(1.0e-6, 0)
+    solver.solve(1.0, 1.0, 200.0, [1.3, 2.25])
+    ncalls = solver.ncalls
+    # a nearby system, started from the last solution
+    solver.solve(1.1, 1.0, 205.0, [1.0, np.log10(200.0)])
+    assert solver.ncalls - ncalls < ncalls
+
+def test_solve_fails_on_a_noise_floor_above_ftol():
+    solver = ToySolver(1.0, 0)
+    with pytest.raises(Exception, match='root solve failed'):
+        solver.solve(1.0, 1.0, 200.0, [1.3, 2.25])
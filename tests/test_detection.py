@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import pytest
+
+from detection import detection_sigma, savage_dickey_lnB
+from priors import retrieved_parameters, gas_parameter
+
+RPARS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'input', 'rpars.txt')
+
+def test_detection_sigma_calibration():
+    # Benneke & Seager (2013), Table 2
+    for lnB, sigma in [(0.9, 2.0), (3.0, 2.9), (5.0, 3.6), (11.0, 5.1)]:
+        assert detection_sigma(lnB) == pytest.approx(sigma, abs=0.05)
+
+def test_detection_sigma_limits():
+    # B <= 1 is p = 1/e, and the significance is continuous there
+    sigma0 = detection_sigma(0.0)
+    assert sigma0 == pytest.approx(0.9005, abs=1e-4)
+    assert detection_sigma(-10.0) == sigma0
+    assert detection_sigma(1e-12) == pytest.approx(sigma0, abs=1e-5)
+    # finite for ln B far beyond where p underflows, with sigma ~ sqrt(2 ln B)
+    assert np.isfinite(detection_sigma(800.0))
+    assert detection_sigma(1e6)/np.sqrt(2e6) == pytest.approx(1.0, abs=1e-3)
+    assert np.isnan(detection_sigma(np.nan))
+
+def test_detection_sigma_increases():
+    lnB = np.concatenate([[0.0], np.logspace(-8, 4, 200)])
+    sigma = [detection_sigma(a) for a in lnB]
+    assert np.all(np.diff(sigma) > 0)
+
+def fake_results(u):
+    # equal-weight posterior samples with fH2O in the column of u
+    n = len(u)
+    names = [par['name'] for par in retrieved_parameters(RPARS)]
+    samples_u = np.full((n, len(names)), 0.5)
+    samples_u[:,names.index(gas_parameter('h2o'))] = u
+    return {'samples_u': samples_u, 'logwt': np.zeros(n)}
+
+def test_savage_dickey_flat_posterior():
+    # a posterior equal to the prior gives B = 1
+    u = (np.arange(100000) + 0.5)/100000
+    lnB, lower_limit = savage_dickey_lnB(fake_results(u), RPARS, 'h2o')
+    assert lnB == pytest.approx(0.0, abs=0.01)
+    assert not lower_limit
+
+def test_savage_dickey_lower_limit():
+    # no samples near the edge only bound ln B from below
+    u = np.linspace(0.5, 1.0, 1000)
+    lnB, lower_limit = savage_dickey_lnB(fake_results(u), RPARS, 'h2o')
+    assert lower_limit
+    assert lnB == pytest.approx(np.log(1000*0.05))
@@ -0,0 +1,37 @@
+import os
+import pickle
+
+import manifest
+
+def write(filename, obj):
+    with open(filename,'wb') as f:
+        pickle.dump(obj, f)
+
+def test_output_valid_follows_the_file(tmp_path):
+    root = str(tmp_path/'T288_SNR10')
+    filename = manifest.output_filename(root, 'all')
+    m = {}
+    assert not manifest.output_valid(m, root, 'all')
+
+    write(filename, {'logz': [1.0]})
+    # not recorded yet
+    assert not manifest.output_valid(m, root, 'all')
+    manifest.record_output(m, root, 'all')
+    assert manifest.output_valid(m, root, 'all')
+
+    # a changed file is not trusted
+    write(filename, {'logz': [2.0, 3.0]})
+    assert not manifest.output_valid(m, root, 'all')
+    os.remove(filename)
+    assert not manifest.output_valid(m, root, 'all')
+
+def test_locked_manifest_saves(tmp_path):
+    save_dir = str(tmp_path)
+    root = os.path.join(save_dir, 'T288_SNR10')
+    with manifest.locked_manifest(save_dir) as m:
+        manifest.set_status(m, root, 'partial')
+    with manifest.locked_manifest(save_dir) as m:
+        assert manifest.get_entry(m, root)['status'] == 'partial'
+        manifest.set_status(m, root, 'done')
+    assert manifest.load_manifest(save_dir)['T288_SNR10']['status'] == 'done'
+    assert sorted(os.listdir(save_dir)) == ['manifest.json', 'manifest.json.lock']
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import runtimes
+
+def record(label, SNR, T_surf, seconds, workers=1):
+    return {'experiment': 'e', 'label': label, 'SNR': SNR, 'params': {'T_surf': T_surf},
+            'seconds': seconds, 'workers': workers}
+
+def test_model_recovers_log_linear_costs():
+    # cost = 10 SNR^1.5 exp(0.01 T_surf)
+    history = []
+    for SNR in (5.0, 10.0, 20.0, 40.0):
+        for T_surf in (250.0, 300.0, 350.0):
+            cost = 10*SNR**1.5*np.exp(0.01*T_surf)
+            history.append(record('all', SNR, T_surf, cost/2, workers=2))
+    model = runtimes.RuntimeModel(history)
+    expected = 10*15.0**1.5*np.exp(0.01*280.0)
+    assert model.predict('e', 'all', 15.0, {'T_surf': 280.0}) == pytest.approx(expected)
+
+def test_model_falls_back():
+    model = runtimes.RuntimeModel([])
+    assert model.predict('e', 'all', 10.0, {}) is None
+    # a fit in SNR only, over all records
+    model = runtimes.RuntimeModel([record('all', 10.0, 300.0, 100.0), record('all', 20.0, 300.0, 400.0)])
+    assert model.predict('other', 'noH2O', 40.0, {'T_surf': 300.0}) == pytest.approx(1600.0)
+    # too few records for any fit: their geometric mean
+    model = runtimes.RuntimeModel([record('all', 10.0, 300.0, 100.0)])
+    assert model.predict('e', 'all', 40.0, {'T_surf': 300.0}) == pytest.approx(100.0)
+
+def test_predict_makespan():
+    assert runtimes.predict_makespan([4.0, 3.0, 3.0, 2.0], 2) == 6.0
+    assert runtimes.predict_makespan([5.0], 8) == 5.0
+    assert runtimes.predict_makespan([], 4) == 0.0
+
+def test_locked_history(tmp_path):
+    filename = str(tmp_path/'runtime_history.json')
+    for i in range(3):
+        with runtimes.locked_history(filename) as history:
+            history.append(record('all', 10.0, 300.0, float(i)))
+    assert [a['seconds'] for a in runtimes.load_history(filename)] == [0.0, 1.0, 2.0]
@@ -0,0 +1,75 @@
+import os
+import pickle
+import signal
+import multiprocessing
+import numpy as np
+import pytest
+
+pytest.importorskip('rfast')
+pytest.importorskip('clima')
+import scheduler
+import manifest
+
+def fake_generate_data(model, atmosphere, clima, climate_cache, FpFs_err, templates, SNRs, instrument_log=None):
+    lam = np.arange(3.0)
+    return [(lam, np.ones(3), np.ones(3), np.ones(3)/SNR) for SNR in SNRs]
+
+def fake_retrieval(outfile):
+    with open(outfile,'wb') as fil:
+        pickle.dump({'logz': [0.0]}, fil)
+
+def fake_spawn_retrieval(task, dat, err, units, workers=1):
+    processes = []
+    for label, gas in units:
+        p = multiprocessing.Process(target=fake_retrieval, args=(manifest.output_filename(task['filename'], label),))
+        p.start()
+        processes.append(p)
+    return processes
+
+def make_tasks(save_dir, npoints, detection):
+    tasks = []
+    for k in range(npoints):
+        task = {}
+        task['filename'] = str(save_dir/('point%i'%k))
+        task['model'] = 'temperature'
+        task['atmosphere'] = {'T_surf': 280.0 + k}
+        task['template'] = 'template.scr'
+        task['clima'] = {}
+        task['climate_cache'] = None
+        task['rpars'] = 'rpars.txt'
+        task['SNR'] = 10.0
+        task['FpFs_err'] = 1e-11
+        task['gases'] = ['h2o']
+        task['detection'] = detection
+        task['info'] = {}
+        tasks.append(task)
+    return tasks
+
+@pytest.fixture
+def stubbed(monkeypatch):
+    monkeypatch.setattr(scheduler, 'generate_data', fake_generate_data)
+    monkeypatch.setattr(scheduler, 'spawn_retrieval', fake_spawn_retrieval)
+    monkeypatch.setattr(scheduler, 'get_retrieval', lambda template, rpars: None)
+    # a deadlock fails the test instead of hanging it
+    def timeout(signum, frame):
+        raise Exception('run_pipeline did not finish')
+    signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(60)
+    yield
+    signal.alarm(0)
+
+@pytest.mark.parametrize('max_processes, data_processes, detection',
+                         [(2, 1, 'savage_dickey'), (3, 1, 'two_run'), (4, 2, 'two_run')])
+def test_pipeline_runs_every_retrieval(tmp_path, stubbed, max_processes, data_processes, detection):
+    tasks = make_tasks(tmp_path, 4, detection)
+    scheduler.run_pipeline(tasks, max_processes, data_processes)
+    m = manifest.load_manifest(str(tmp_path))
+    for task in tasks:
+        for label, gas in scheduler.retrieval_units(task):
+            assert manifest.output_valid(m, task['filename'], label)
+
+def test_pipeline_needs_cores_next_to_the_data_workers(tmp_path, stubbed):
+    # two retrievals per task do not fit next to the data workers
+    for max_processes, data_processes in [(2, 1), (4, 4)]:
+        with pytest.raises(Exception, match='max_processes'):
+            scheduler.run_pipeline(make_tasks(tmp_path, 4, 'two_run'), max_processes, data_processes)
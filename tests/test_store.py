@@ -0,0 +1,70 @@
+import os
+import pickle
+import numpy as np
+
+import store
+
+def fake_results(logz):
+    results = {}
+    results['logz'] = np.array([-10.0, logz])
+    results['logzerr'] = np.array([1.0, 0.2])
+    results['samples'] = np.arange(6.0).reshape(3, 2)
+    results['niter'] = 3
+    # entries that are not numeric arrays are not kept
+    results['bound'] = [object()]
+    return results
+
+def write(filename, obj):
+    with open(filename,'wb') as f:
+        pickle.dump(obj, f)
+
+def test_data_round_trip(tmp_path):
+    filename = store.store_path(str(tmp_path))
+    lam = np.linspace(0.8, 1.0, 5)
+    for name, SNR in [('a', 5.0), ('b', 10.0)]:
+        store.write_data(filename, name, lam, 0.01*np.ones(5), np.ones(5), np.ones(5)/SNR, {'SNR': SNR})
+    sol = store.read_data(filename, 'b')
+    assert np.array_equal(sol['lam'], lam)
+    assert np.array_equal(sol['err'], np.ones(5)/10.0)
+    assert sol['SNR'] == 10.0
+    assert store.has_output(filename, 'a', 'data')
+    assert not store.has_output(filename, 'a', 'all')
+    # both points share one wavelength grid
+    with store.open_store(filename) as f:
+        assert len(f['grids']) == 1
+
+def test_ingest_results(tmp_path):
+    save_dir = str(tmp_path)
+    filename = store.store_path(save_dir)
+    outfile = os.path.join(save_dir, 'a_all.pkl')
+    write(outfile, fake_results(3.0))
+    store.ingest_results(filename, 'a', 'all', outfile, {'SNR': 5.0})
+
+    assert store.has_output(filename, 'a', 'all')
+    results = store.read_results(filename, 'a', 'all')
+    assert results['logz'][-1] == 3.0
+    assert results['niter'] == 3
+    assert 'bound' not in results
+    assert set(store.read_results(filename, 'a', 'all', ['logz'])) == {'logz'}
+
+    # a rerun replaces its row of the evidence table
+    write(outfile, fake_results(4.0))
+    store.ingest_results(filename, 'a', 'all', outfile, {'SNR': 5.0})
+    evidence = store.read_evidence(filename)
+    assert list(evidence) == [('a', 'all')]
+    assert evidence[('a', 'all')]['logz'] == 4.0
+    assert evidence[('a', 'all')]['SNR'] == 5.0
+
+def test_prune_keeps_changed_pickles(tmp_path):
+    save_dir = str(tmp_path)
+    filename = store.store_path(save_dir)
+    for name in ['a', 'b']:
+        outfile = os.path.join(save_dir, name+'_all.pkl')
+        write(outfile, fake_results(3.0))
+        store.ingest_results(filename, name, 'all', outfile, {'SNR': 5.0})
+    # b was rerun after it was stored
+    write(os.path.join(save_dir, 'b_all.pkl'), fake_results(4.0))
+
+    store.prune(save_dir)
+    assert not os.path.isfile(os.path.join(save_dir, 'a_all.pkl'))
+    assert os.path.isfile(os.path.join(save_dir, 'b_all.pkl'))
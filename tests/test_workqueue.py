@@ -0,0 +1,73 @@
+import workqueue
+
+def make_queue(tmp_path):
+    return workqueue.connect(str(tmp_path/'q.sqlite'))
+
+def status(con, key):
+    return con.execute('SELECT status FROM jobs WHERE key = ?', (key,)).fetchone()[0]
+
+def test_claims_by_priority_after_requirements(tmp_path):
+    con = make_queue(tmp_path)
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'data', 'data', {}, float('inf'))
+        workqueue.add_job(con, 'low', 'retrieval', {}, 1.0, ['data'])
+        workqueue.add_job(con, 'high', 'retrieval', {}, 2.0, ['data'])
+
+    assert workqueue.claim(con, 'w')[0] == 'data'
+    # retrievals wait for their data
+    assert workqueue.claim(con, 'w') is None
+    workqueue.complete(con, 'data', 'w')
+    assert workqueue.claim(con, 'w')[0] == 'high'
+    assert workqueue.claim(con, 'w')[0] == 'low'
+    assert workqueue.remaining(con) == 2
+
+def test_failed_requirement_fails_dependents(tmp_path):
+    con = make_queue(tmp_path)
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'data', 'data', {}, float('inf'))
+        workqueue.add_job(con, 'retrieval', 'retrieval', {}, 1.0, ['data'])
+
+    for i in range(workqueue.MAX_ATTEMPTS):
+        assert workqueue.claim(con, 'w')[0] == 'data'
+        workqueue.fail(con, 'data', 'w', 'error')
+    assert status(con, 'data') == 'failed'
+    assert status(con, 'retrieval') == 'failed'
+    assert workqueue.claim(con, 'w') is None
+
+def test_expired_lease_is_requeued(tmp_path):
+    con = make_queue(tmp_path)
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'job', 'retrieval', {'a': 1}, 1.0)
+
+    key, kind, payload = workqueue.claim(con, 'w1')
+    assert payload == {'a': 1}
+    con.execute('UPDATE jobs SET lease_expires = 0')
+    assert workqueue.claim(con, 'w2')[0] == 'job'
+    # the first worker lost its lease
+    assert not workqueue.heartbeat(con, 'job', 'w1')
+    assert workqueue.heartbeat(con, 'job', 'w2')
+
+def test_requeue_gives_up_after_max_attempts(tmp_path):
+    con = make_queue(tmp_path)
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'job', 'retrieval', {}, 1.0)
+
+    for i in range(workqueue.MAX_ATTEMPTS):
+        assert workqueue.claim(con, 'w')[0] == 'job'
+        con.execute('UPDATE jobs SET lease_expires = 0')
+    assert workqueue.claim(con, 'w') is None
+    assert status(con, 'job') == 'failed'
+
+def test_adding_a_failed_job_retries_it(tmp_path):
+    con = make_queue(tmp_path)
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'job', 'retrieval', {}, 1.0)
+    for i in range(workqueue.MAX_ATTEMPTS):
+        workqueue.claim(con, 'w')
+        workqueue.fail(con, 'job', 'w', 'error')
+    assert status(con, 'job') == 'failed'
+
+    with workqueue.transaction(con):
+        workqueue.add_job(con, 'job', 'retrieval', {}, 1.0)
+    assert status(con, 'job') == 'pending'
+    assert workqueue.job_counts(con) == {('retrieval', 'pending'): 1}
@@ -1,7 +1,61 @@
 import numpy as np
 from scipy import optimize
+import hashlib
+import json
+import os
+import tempfile
+import importlib.metadata
+from concurrent.futures import ProcessPoolExecutor
 
+import instrument
+from fileio import atomic_write
+
+import rfast
 from rfast import Rfast
+from clima import AdiabatClimate
+
+def make_climate(settings):
+    c = AdiabatClimate(settings['species_file'],
+                       settings['settings_file'],
+                       settings['star_file'])
+    apply_climate_settings(c, settings)
+    return c
+
+def apply_climate_settings(c, settings):
+    # the settings that calculations change (e.g. the HZ solve sets T_trop)
+    c.use_make_column_P_guess = False
+    c.P_top = settings['P_top']
+    c.RH = np.ones(len(c.species_names))*settings['RH']
+    c.T_trop = settings['T_trop']
+    c.rad.surface_albedo = settings['surface_albedo']
+
+# One AdiabatClimate per process and clima settings, and the settings
+# each pooled climate was made with (used by the climate cache)
+_CLIMATE_POOL = {}
+_CLIMATE_SETTINGS = {}
+
+def get_climate(settings):
+    # A pooled climate is reset to its settings on every call, so no state
+    # left by a previous calculation leaks into the next one
+    key = json.dumps(settings, sort_keys=True)
+    if key not in _CLIMATE_POOL:
+        _CLIMATE_POOL[key] = make_climate(settings)
+        _CLIMATE_SETTINGS[id(_CLIMATE_POOL[key])] = settings
+    else:
+        apply_climate_settings(_CLIMATE_POOL[key], settings)
+    return _CLIMATE_POOL[key]
+
+def species_array(c, values):
+    # dict of species -> value, in clima species order
+    for sp in values:
+        if sp not in c.species_names:
+            raise Exception(sp+' is not a clima species.')
+    arr = np.empty(len(c.species_names))
+    for i,sp in enumerate(c.species_names):
+        if sp not in values:
+            raise Exception('No value for '+sp+'.')
+        arr[i] = values[sp]
+    return arr
 
 def equilibrium_temperature(stellar_radiation, bond_albedo):
     sigma_si = 5.670374419e-8
@@ -25,6 +79,7 @@ def objective(x, c, N_i, distance_au, T_surf):
     N_i[c.species_names.index('CO2')] = N_CO2
     
     # radiative transfer
+    instrument.count('TOA_fluxes_column')
     ISR, OLR = c.TOA_fluxes_column(T_surf, N_i)
     ISR = ISR*solar_scaling # rescale solar flux to distance from sun
     
@@ -40,200 +95,676 @@ def objective(x, c, N_i, distance_au, T_surf):
     
     return fvec
 
-def find_CO2_for_stable_climate(c, N_i, distance_au, T_surf, N_CO2_guess, T_trop_guess):
-    args = (c, N_i, distance_au, T_surf)
+def climate_features(c, N_i, distance_au, T_surf):
+    # Position of a solve in the sweep. Distances are scaled so that
+    # 0.1 AU, 10 K and a factor of 10 in a column count about the same.
+    N_other = np.delete(np.asarray(N_i, dtype=float), c.species_names.index('CO2'))
+    return np.concatenate(([distance_au/0.1, T_surf/10.0], np.log10(N_other)))
+
+class StableClimateSolver():
+    # Solves objective(x) = 0 for x = (log10 N_CO2, log10 T_trop) with a
+    # Broyden method. Evaluations are memoized within a solve, and the
+    # Jacobian of the last solve seeds the next one, so a finite-difference
+    # Jacobian is only computed when Broyden steps stop making progress.
+    # ncalls counts objective (and so TOA_fluxes_column) evaluations.
+    # Converged solutions are kept to warm start later solves.
+    #
+    # A solve has converged once every residual is within ftol: W/m^2 for
+    # OLR - ISR and K for T_skin - T_trop. clima's radiative transfer is
+    # iterative, so the residuals are noisy, and changes of them within
+    # ftol do not update the Jacobian.
+
+    def __init__(self, c, ftol=(1.0e-3, 1.0e-3), max_iter=50, fd_step=1.0e-6, max_step=0.5):
+        self.c = c
+        self.ftol = np.array(ftol, dtype=float)
+        self.max_iter = max_iter
+        self.fd_step = fd_step
+        self.max_step = max_step
+        self.ncalls = 0
+        self.jac = None
+        self.solutions = []
+        self._memo = {}
+        self._last_x = None
+
+    def objective(self, x, N_i, distance_au, T_surf):
+        instrument.count('objective')
+        key = tuple(np.asarray(x, dtype=float))
+        if key not in self._memo:
+            self.ncalls += 1
+            self._memo[key] = objective(np.array(key), self.c, N_i, distance_au, T_surf)
+            self._last_x = key
+        return self._memo[key]
+
+    def set_state(self, x, N_i, distance_au, T_surf):
+        # leave c in the state at x
+        key = tuple(np.asarray(x, dtype=float))
+        if self._last_x != key:
+            self.ncalls += 1
+            objective(np.array(key), self.c, N_i, distance_au, T_surf)
+            self._last_x = key
+
+    def jacobian(self, x, f, args):
+        jac = np.empty((2,2))
+        for j in range(2):
+            dx = np.zeros(2)
+            dx[j] = self.fd_step*max(abs(x[j]), 1.0)
+            jac[:,j] = (self.objective(x + dx, *args) - f)/dx[j]
+        return jac
+
+    def nearest_solution(self, features):
+        if len(self.solutions) == 0:
+            return None
+        dist = [np.linalg.norm(features - f) for f, x in self.solutions]
+        return self.solutions[int(np.argmin(dist))][1]
+
+    def solve(self, N_i, distance_au, T_surf, x0):
+        args = (N_i, distance_au, T_surf)
+        self._memo = {}
+        self._last_x = None
+
+        x = np.array(x0, dtype=float)
+        f = self.objective(x, *args)
+        if np.all(np.abs(f) <= self.ftol):
+            return self.converged(x, args)
+        jac = self.jac if self.jac is not None else self.jacobian(x, f, args)
+        fresh = self.jac is None
+
+        for i in range(self.max_iter):
+            try:
+                dx = np.linalg.solve(jac, -f)
+            except np.linalg.LinAlgError:
+                dx = np.full(2, np.nan)
+            if not np.all(np.isfinite(dx)):
+                if fresh:
+                    break
+                jac = self.jacobian(x, f, args)
+                fresh = True
+                continue
+            norm = np.linalg.norm(dx)
+            if norm > self.max_step:
+                dx *= self.max_step/norm
+
+            # backtrack until the residual, in units of ftol, decreases
+            accepted = False
+            t = 1.0
+            for k in range(4):
+                x1 = x + t*dx
+                f1 = self.objective(x1, *args)
+                if np.all(np.isfinite(f1)) and np.linalg.norm(f1/self.ftol) < np.linalg.norm(f/self.ftol):
+                    accepted = True
+                    break
+                t *= 0.5
+
+            if not accepted:
+                if fresh:
+                    break
+                # Broyden Jacobian is stale; recompute it
+                jac = self.jacobian(x, f, args)
+                fresh = True
+                continue
+
+            if np.any(np.abs(f1 - f) > self.ftol):
+                s = x1 - x
+                jac = jac + np.outer((f1 - f) - jac @ s, s)/(s @ s)
+                fresh = False
+            x, f = x1, f1
+
+            if np.all(np.abs(f) <= self.ftol):
+                self.jac = jac
+                return self.converged(x, args)
+
+        raise Exception('root solve failed')
+
+    def converged(self, x, args):
+        # leave c at the solution x, and check it
+        self.set_state(x, *args)
+        if self.c.T_trop < 100.0:
+            raise Exception('root solve failed')
+        return x
+
+    def solve_hybr(self, N_i, distance_au, T_surf, x0):
+        # The original scipy solve, used as a fallback
+        args = (N_i, distance_au, T_surf)
+        self._memo = {}
+        self._last_x = None
+        sol = optimize.root(self.objective, x0, args=args, method='hybr')
+        if not sol.success:
+            raise Exception('root solve failed')
+        self.set_state(sol.x, *args)
+        if self.c.T_trop < 100.0:
+            raise Exception('root solve failed')
+        return sol.x
+
+# One solver per AdiabatClimate
+_CLIMATE_SOLVERS = {}
+
+def get_climate_solver(c):
+    if id(c) not in _CLIMATE_SOLVERS:
+        _CLIMATE_SOLVERS[id(c)] = StableClimateSolver(c)
+    return _CLIMATE_SOLVERS[id(c)]
+
+def find_CO2_for_stable_climate(c, N_i, distance_au, T_surf, N_CO2_guess, T_trop_guess, warm_start=False):
+    # With warm_start, the solve starts from the solution of the closest
+    # previous solve with c, and falls back to the given guess if that
+    # fails. The Broyden solver is tried first, then scipy's hybr.
+    solver = get_climate_solver(c)
+    features = climate_features(c, N_i, distance_au, T_surf)
     initial_guess = np.log10(np.array([N_CO2_guess, T_trop_guess]))
 
-    sol = optimize.root(objective, initial_guess, args=args, method='hybr')
-    if not sol.success or c.T_trop < 100.0:
+    guesses = []
+    if warm_start:
+        neighbour = solver.nearest_solution(features)
+        if neighbour is not None:
+            guesses.append(neighbour)
+    guesses.append(initial_guess)
+
+    x = None
+    with instrument.stage('find_CO2_for_stable_climate', distance_au=float(distance_au), 
+                          T_surf=float(T_surf)) as fields:
+        for method in (solver.solve, solver.solve_hybr):
+            for guess in guesses:
+                try:
+                    x = method(N_i, distance_au, T_surf, guess)
+                    break
+                except Exception:
+                    x = None
+            if x is not None:
+                break
+        fields['converged'] = x is not None
+    if x is None:
         raise Exception('root solve failed')
-    fvec = objective(sol.x, c, N_i, distance_au, T_surf)
-    
-    N_CO2, T_trop = 10.0**(sol.x)
+
+    solver.solutions.append((features, x.copy()))
+
+    N_CO2, T_trop = 10.0**(x)
     
     return N_CO2
 
-def rewrite_clima_atmosphere(c, tmp_atmosphere_outfile, rfast_species):
-    
-    # species in rfast that are not in clima
-    missing_species = []
-    for sp in rfast_species:
-        if sp not in c.species_names:
-            missing_species.append(sp)
-    
-    # open atmosphere file
-    with open(tmp_atmosphere_outfile,'r') as f:
-        lines = f.readlines()
-    
-    # Add rfast species to labels
-    fmt = '{:27}'
-    labels_line = lines[0].strip('\n')
-    for sp in missing_species:
-        labels_line+=fmt.format(sp)
-    labels_line+='\n'
+def _solve_hz_chunk(clima_settings, N_i, points, N_CO2_guess, T_trop_guess):
+    # Solves a run of neighbouring (distance_au, T_surf) points in order,
+    # each warm started from the previous ones
+    c = get_climate(clima_settings)
+    solver = get_climate_solver(c)
+    out = []
+    for distance_au, T_surf in points:
+        N_i_ = species_array(c, N_i)
+        ncalls = solver.ncalls
+        try:
+            N_CO2 = find_CO2_for_stable_climate(c, N_i_, distance_au, T_surf, 
+                                                N_CO2_guess, T_trop_guess, warm_start=True)
+            bond_albedo = c.rad.wrk_sol.fup_n[-1]/c.rad.wrk_sol.fdn_n[-1]
+            out.append((N_CO2, c.T_trop, bond_albedo, True, solver.ncalls - ncalls))
+        except Exception:
+            out.append((np.nan, np.nan, np.nan, False, solver.ncalls - ncalls))
+    return out
 
-    # Add rfast species to atmosphere file at small concentrations
-    new_lines = []
-    for line in lines[1:]:
-        tmp = line.strip('\n')+'   '
-        for i,sp in enumerate(missing_species):
-            tmp+=fmt.format('%.1e'%(1.0e-50))
-        tmp+='\n'
-        new_lines.append(tmp)
-    
-    # Write the new atmosphere file
-    with open(tmp_atmosphere_outfile,'w') as f:
-        f.write(labels_line)
-        for line in new_lines:
-            f.write(line)
-    
-    # get labels of atmosphere file for later use
-    labels = labels_line.split()
-    
-    return labels
+def solve_habitable_zone(clima_settings, N_i, distances, T_surfs=288.0, 
+                         N_CO2_guess=46.0, T_trop_guess=185.0, processes=1):
+    # CO2 columns needed for a stable climate at each distance (and
+    # surface temperature). N_i is a dict of species -> column; its CO2
+    # entry is solved for. Points are sorted by T_surf and distance and
+    # split into one contiguous run per process, so each solve starts from
+    # its neighbour. Results are returned in the input order.
+    distances = np.atleast_1d(np.asarray(distances, dtype=float))
+    T_surfs = np.broadcast_to(np.asarray(T_surfs, dtype=float), distances.shape).copy()
+
+    order = np.lexsort((distances, T_surfs))
+    chunks = [chunk for chunk in np.array_split(order, processes) if len(chunk) > 0]
 
-def make_rfast_from_clima(template_filename, c, distance_au, 
-                          tmp_atmosphere_outfile='tmp12345_atmosphere.txt', 
-                          tmp_scr_outfile='tmp12345.scr'):
+    args = []
+    for chunk in chunks:
+        points = [(distances[i], T_surfs[i]) for i in chunk]
+        args.append((clima_settings, N_i, points, N_CO2_guess, T_trop_guess))
 
-    # Write clima file
-    c.out2atmosphere_txt(tmp_atmosphere_outfile, eddy=np.zeros(c.z.shape[0]), overwrite=True)
+    if processes == 1:
+        results = [_solve_hz_chunk(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(_solve_hz_chunk, *a) for a in args]
+            results = [f.result() for f in futures]
 
-    # read template file
+    sol = {}
+    sol['distance_au'] = distances
+    sol['T_surf'] = T_surfs
+    sol['N_CO2'] = np.empty(distances.shape)
+    sol['T_trop'] = np.empty(distances.shape)
+    sol['bond_albedo'] = np.empty(distances.shape)
+    sol['converged'] = np.empty(distances.shape, dtype=bool)
+    sol['ncalls'] = np.empty(distances.shape, dtype=int)
+    for chunk, out in zip(chunks, results):
+        for i, (N_CO2, T_trop, bond_albedo, converged, ncalls) in zip(chunk, out):
+            sol['N_CO2'][i] = N_CO2
+            sol['T_trop'][i] = T_trop
+            sol['bond_albedo'][i] = bond_albedo
+            sol['converged'][i] = converged
+            sol['ncalls'][i] = ncalls
+    return sol
+
+def file_hash(filename):
+    with open(filename,'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def template_species(template_filename):
+    # radiatively active species in an rfast template, in clima naming
     with open(template_filename,'r') as f:
         lines = f.readlines()
-
-    # keys we we need to find
-    keys = [
-        'pmax ',
-        'species_r ',
-        'rdgas ',
-        'fnatm ',
-        'skpatm ',
-        'colr ',
-        'colpr ',
-        'psclr ',
-        'imix ',
-        't0 ',
-        'rdtmp ',
-        'fntmp ',
-        'skptmp ',
-        'colt ',
-        'colpt ',
-        'psclt ',
-        'a '
-    ]
-    
-    # check keys exist in the file
-    i = 0
-    for key in keys:
-        for line in lines:
-            if line.startswith(key):
-                i+=1
-                break
-    if i != len(keys):
-        raise Exception('Can not find key in template scr file.')
-    
-    # get rfast species
     for line in lines:
         if line.startswith('species_r '):
             a = line.split('#')[0].split('=')[1].strip().split(',')
-            rfast_species = [b.upper() for b in a]
-            break
+            return [b.upper() for b in a]
+    raise Exception('Can not find key in template scr file.')
 
-    # rewrite atmosphere file so it works well with rfast
-    clima_file_labels = rewrite_clima_atmosphere(c, tmp_atmosphere_outfile, rfast_species)
-    
-    # change file to match what is in clima
+def climate_state(c):
+    # Converged clima state, enough to make the rfast inputs
+    state = {}
+    state['species_names'] = list(c.species_names)
+    state['z'] = np.array(c.z)
+    state['P'] = np.array(c.P)
+    state['T'] = np.array(c.T)
+    state['f_i'] = np.array(c.f_i)
+    state['T_surf'] = float(c.T_surf)
+    state['P_surf'] = float(c.P_surf)
+    state['T_trop'] = float(c.T_trop)
+    return state
+
+def clima_rfast_inputs(state, rfast_species):
+
+    # Surface followed by the atmospheric layers (same rows as out2atmosphere_txt)
+    P = np.append(state['P_surf'], state['P'])/10.0 # dynes/cm^2 to Pa
+    T = np.append(state['T_surf'], state['T'])
+
+    # rfast species that are not in clima get small concentrations
+    f = np.empty((len(rfast_species),P.shape[0]))
+    for i,sp in enumerate(rfast_species):
+        if sp in state['species_names']:
+            ind = state['species_names'].index(sp)
+            f[i,:] = np.append(state['f_i'][0,ind], state['f_i'][:,ind])
+        else:
+            f[i,:] = 1.0e-50
+
+    inputs = {}
+    inputs['species'] = rfast_species
+    inputs['P'] = P
+    inputs['T'] = T
+    inputs['f'] = f
+    inputs['pmax'] = P[0]
+    inputs['t0'] = T[0]
+    return inputs
+
+def write_rfast_inputs(template_filename, inputs, distance_au, atmosphere_outfile, scr_outfile):
+    # Writes the clima profiles to an atmosphere file and a copy of the
+    # template that reads them (rdgas and rdtmp), through rfast's documented
+    # file inputs. Columns are pressure (Pa), temperature, then the species.
+    fmt = '{:27}'
+    with open(atmosphere_outfile,'w') as f:
+        f.write(''.join(fmt.format(a) for a in ['press', 'temp'] + inputs['species'])+'\n')
+        for j in range(inputs['P'].shape[0]):
+            row = [inputs['P'][j], inputs['T'][j]] + list(inputs['f'][:,j])
+            f.write(''.join(fmt.format('%.8e'%a) for a in row)+'\n')
+
+    new_values = {}
+    new_values['pmax'] = '%.5e'%inputs['pmax']
+    new_values['rdgas'] = 'True'
+    new_values['fnatm'] = atmosphere_outfile
+    new_values['skpatm'] = '1'
+    new_values['colr'] = ','.join('%i'%(i+3) for i in range(len(inputs['species'])))
+    new_values['colpr'] = '1'
+    new_values['psclr'] = '1.0'
+    new_values['imix'] = '0'
+    new_values['t0'] = '%.1f'%inputs['t0']
+    new_values['rdtmp'] = 'True'
+    new_values['fntmp'] = atmosphere_outfile
+    new_values['skptmp'] = '1'
+    new_values['colt'] = '2'
+    new_values['colpt'] = '1'
+    new_values['psclt'] = '1.0'
+    new_values['a'] = '%.6f'%distance_au
+
+    with open(template_filename,'r') as f:
+        lines = f.readlines()
+    found = set()
     new_lines = []
     for line in lines:
-        new_line = line
-        if line.startswith('pmax '):
-            new_line = 'pmax = %.5e\n'%(((c.P_surf/1e6)*1e5))
-        if line.startswith('species_r '):
-            a = line.split('#')[0].split('=')[1].strip().split(',')
-            rfast_species = [b.upper() for b in a]
-            colr_list = [clima_file_labels.index(b)+1 for b in rfast_species]
-            colr = ','.join(['%i'%b for b in colr_list])
-        if line.startswith('rdgas '):
-            new_line = 'rdgas = True\n'
-        if line.startswith('fnatm '):
-            new_line = 'fnatm = '+tmp_atmosphere_outfile+'\n'
-        if line.startswith('skpatm '):
-            new_line = 'skpatm = 1\n'
-        if line.startswith('colr '):
-            new_line = 'colr = '+colr+'\n'
-        if line.startswith('colpr '):
-            new_line = 'colpr = 2\n'
-        if line.startswith('psclr '):
-            new_line = 'psclr = 1.0e5\n'
-        if line.startswith('imix '):
-            new_line = 'imix = 0\n'
-        if line.startswith('t0 '):
-            new_line = 't0 = %.1f\n'%(c.T_surf)
-        if line.startswith('rdtmp '):
-            new_line = 'rdtmp = True\n'
-        if line.startswith('fntmp '):
-            new_line = 'fntmp = '+tmp_atmosphere_outfile+'\n'
-        if line.startswith('skptmp '):
-            new_line = 'skptmp = 1\n'
-        if line.startswith('colt '):
-            new_line = 'colt = 4\n'
-        if line.startswith('colpt '):
-            new_line = 'colpt = 2\n'
-        if line.startswith('psclt '):
-            new_line = 'psclt = 1.0e5\n'
-        if line.startswith('a '):
-            new_line = 'a = %.6f\n'%(distance_au)
-
-        new_lines.append(new_line)
-
-    # write the new file
-    with open(tmp_scr_outfile,'w') as f:
-        for line in new_lines:
-            f.write(line)
-            
-    r = Rfast(tmp_scr_outfile)
+        key = line.split('=')[0].strip() if '=' in line and not line.startswith('#') else None
+        if key in new_values:
+            line = key+' = '+new_values[key]+'\n'
+            found.add(key)
+        new_lines.append(line)
+    if len(found) != len(new_values):
+        raise Exception('Can not find key in template scr file.')
+    with open(scr_outfile,'w') as f:
+        f.writelines(new_lines)
+
+# Large arrays of an Rfast instance (the opacities, already interpolated to
+# the template wavelength grid) are written once to a cache directory and
+# replaced by memory maps of those files. Every process that maps them,
+# including retrievals forked from the parent, shares the same pages. The
+# maps are copy-on-write, so a write by rfast stays private to the process
+# instead of raising.
+SHARE_MIN_BYTES = 1 << 20
+_OPACITY_CACHE = {'dir': None}
+
+def set_opacity_cache(cache_dir):
+    # None turns sharing off
+    _OPACITY_CACHE['dir'] = cache_dir
+
+def rfast_version():
+    try:
+        return importlib.metadata.version('rfast')
+    except importlib.metadata.PackageNotFoundError:
+        return str(getattr(rfast, '__version__', None))
+
+def template_value(template_filename, key, default=None):
+    # value of key in an rfast template, or default if it has no such key
+    # and a default is given
+    with open(template_filename,'r') as f:
+        for line in f:
+            if '=' in line and not line.startswith('#') and line.split('=')[0].strip() == key:
+                return line.split('#')[0].split('=',1)[1].strip()
+    if default is not None:
+        return default
+    raise Exception('Can not find key in template scr file.')
+
+def directory_stamp(h, directory):
+    # Adds the name, size and mtime of every file below directory to the
+    # hash h. Hashing the contents of the opacities would take longer than
+    # reading them, and replacing a file changes its size or mtime.
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            h.update(os.path.relpath(os.path.join(root, name), directory).encode())
+            h.update(('%i %i'%(st.st_size, st.st_mtime_ns)).encode())
+
+_OPACITY_KEYS = {}
+
+def opacity_key(template_filename, *filenames):
+    # Key of the shared arrays of an Rfast built from the template (and
+    # e.g. a retrieval parameter file). It changes with the files, the
+    # version of rfast and its opacities: those in the rfast package, and
+    # in opdir if the template sets one.
+    key = (os.path.abspath(template_filename),) + tuple(os.path.abspath(a) for a in filenames)
+    if key not in _OPACITY_KEYS:
+        h = hashlib.sha256()
+        for filename in (template_filename,) + filenames:
+            h.update(file_hash(filename).encode())
+        h.update(rfast_version().encode())
+        directory_stamp(h, os.path.dirname(os.path.abspath(rfast.__file__)))
+        opdir = template_value(template_filename, 'opdir', '')
+        if opdir != '':
+            directory_stamp(h, opdir)
+        _OPACITY_KEYS[key] = h.hexdigest()
+    return _OPACITY_KEYS[key]
+
+def share_rfast_arrays(r, template_filename, *filenames):
+    # r is built from the template (and e.g. a retrieval parameter file in
+    # filenames). The cache subdirectory is named by their opacity_key.
+    if _OPACITY_CACHE['dir'] is None:
+        return
+    cache_dir = os.path.join(_OPACITY_CACHE['dir'], opacity_key(template_filename, *filenames))
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, val in list(vars(r).items()):
+        # scr holds the atmosphere, which we change for every spectrum
+        if name == 'scr' or not isinstance(val, np.ndarray) or isinstance(val, np.memmap):
+            continue
+        if val.dtype == object or val.nbytes < SHARE_MIN_BYTES:
+            continue
+        filename = os.path.join(cache_dir, name+'.npy')
+        shared = None
+        if os.path.isfile(filename):
+            shared = np.load(filename, mmap_mode='c')
+            if shared.shape != val.shape or shared.dtype != val.dtype:
+                shared = None
+        if shared is None:
+            with atomic_write(filename) as f:
+                np.save(f, val)
+            shared = np.load(filename, mmap_mode='c')
+        setattr(r, name, shared)
+
+# rfast has no in-memory way to set the atmosphere of an instance, so the
+# files it reads are written here, in memory where the system allows.
+RFAST_TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def make_rfast_from_state(template_filename, state, distance_au):
+    # Rfast reads the atmosphere files when it is constructed, so they are
+    # written to a private directory (concurrent workers never share them)
+    # that is removed right after.
+    inputs = clima_rfast_inputs(state, template_species(template_filename))
+    with tempfile.TemporaryDirectory(prefix='rfast_', dir=RFAST_TMP_DIR) as tmp_dir:
+        atmosphere_outfile = os.path.join(tmp_dir, 'atmosphere.txt')
+        scr_outfile = os.path.join(tmp_dir, 'input.scr')
+        with instrument.stage('make_rfast_from_clima', template=template_filename):
+            write_rfast_inputs(template_filename, inputs, distance_au, atmosphere_outfile, scr_outfile)
+        with instrument.stage('Rfast', template=template_filename):
+            r = Rfast(scr_outfile)
     return r
 
-def make_data_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, 
-                                     template_filename, SNR, FpFs_err,
-                                     tmp_atmosphere_outfile='tmp12345_atmosphere.txt', 
-                                     tmp_scr_outfile='tmp12345.scr'):
+def make_rfast_from_clima(template_filename, c, distance_au):
+    return make_rfast_from_state(template_filename, climate_state(c), distance_au)
 
-    # Construct atmosphere
-    c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+# Converged climate states on disk, keyed on the clima input files,
+# settings and the atmosphere, so identical atmospheres are computed once
+# across experiments and reruns.
 
-    # make rfast from clima results
-    r = make_rfast_from_clima(template_filename, c, 1.0, tmp_atmosphere_outfile, tmp_scr_outfile)
+def climate_cache_key(c, model, **inputs):
+    if id(c) not in _CLIMATE_SETTINGS:
+        return None
+    settings = _CLIMATE_SETTINGS[id(c)]
+    key = {}
+    key['model'] = model
+    key['species_file'] = file_hash(settings['species_file'])
+    key['settings_file'] = file_hash(settings['settings_file'])
+    key['star_file'] = file_hash(settings['star_file'])
+    key['RH'] = np.asarray(c.RH, dtype=float).tolist()
+    key['P_top'] = float(c.P_top)
+    key['surface_albedo'] = float(c.rad.surface_albedo)
+    for k in inputs:
+        val = inputs[k]
+        if isinstance(val, np.ndarray):
+            val = val.tolist()
+        key[k] = val
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
 
-    # compute the spectrum
-    F1, F2 = r.genspec_scr()
+def load_climate_state(cache_dir, key):
+    if key is None:
+        return None
+    filename = os.path.join(cache_dir, key+'.npz')
+    if not os.path.isfile(filename):
+        return None
+    with np.load(filename) as dat:
+        state = {}
+        state['species_names'] = [str(a) for a in dat['species_names']]
+        for k in ['z','P','T','f_i']:
+            state[k] = dat[k]
+        for k in ['T_surf','P_surf','T_trop']:
+            state[k] = float(dat[k])
+    return state
 
-    # set SNR and generate data
-    assert r.scr.snr0.shape[0] == 1 
-    r.scr.snr0 = np.array([SNR])
-    dat, err = r.noise_at_FpFs(F2, FpFs_err)
+def save_climate_state(cache_dir, key, state):
+    if key is None:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = os.path.join(cache_dir, key+'.npz')
+    with atomic_write(filename) as f:
+        np.savez(f, **state)
 
-    return dat, err
+# Spectra keyed on atmospheric state and template. With rnd = False the
+# SNR only changes the error bars, so each atmosphere is computed once.
+# The Rfast that made a spectrum is kept with it, as the noise depends on
+# its scr (e.g. the distance and surface temperature). Only the last
+# SPECTRUM_CACHE_SIZE made are kept, as every Rfast holds its own opacities.
+# Climate states are also kept in memory, so several bands (rfast templates
+# that differ only in wavelength range or resolution) share one atmosphere.
+SPECTRUM_CACHE_SIZE = 8
+_SPECTRUM_CACHE = {}
+_STATE_CACHE = {}
 
-def make_data_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
-                            template_filename, SNR, FpFs_err,
-                            tmp_atmosphere_outfile='tmp12345_atmosphere.txt', 
-                            tmp_scr_outfile='tmp12345.scr'):
+def hash_key(key):
+    key = dict(key)
+    for k in key:
+        if isinstance(key[k], np.ndarray):
+            key[k] = key[k].tolist()
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def spectrum_cache_key(template_filename, **state):
+    key = dict(state)
+    key['template'] = file_hash(template_filename)
+    return hash_key(key)
+
+def clear_spectrum_cache():
+    _SPECTRUM_CACHE.clear()
+    _STATE_CACHE.clear()
 
-    # Construct atmosphere
-    N_CO2 = find_CO2_for_stable_climate(c, N_i, distance_au, T_surf, N_CO2_guess, T_trop_guess)
+def atmosphere_key(c, model, **inputs):
+    # in-memory key of an atmosphere made by c in this process
+    key = dict(inputs)
+    key['model'] = model
+    key['climate'] = id(c)
+    key['P_top'] = float(c.P_top)
+    key['RH'] = np.asarray(c.RH, dtype=float)
+    key['surface_albedo'] = float(c.rad.surface_albedo)
+    return hash_key(key)
+
+def cached_climate_state(c, model, compute, climate_cache_dir=None, **inputs):
+    # Returns (key, state) for the atmosphere given by inputs, calling
+    # compute() to run clima only if it is not in memory or on disk.
+    key = atmosphere_key(c, model, **inputs)
+    if key in _STATE_CACHE:
+        return key, _STATE_CACHE[key]
+
+    state = None
+    if climate_cache_dir is not None:
+        ckey = climate_cache_key(c, model, **inputs)
+        state = load_climate_state(climate_cache_dir, ckey)
+    if state is None:
+        compute()
+        state = climate_state(c)
+        if climate_cache_dir is not None:
+            save_climate_state(climate_cache_dir, ckey, state)
+
+    _STATE_CACHE[key] = state
+    return key, state
+
+def spectrum_from_state(template_filename, atm_key, state, distance_au):
+    key = spectrum_cache_key(template_filename, atmosphere=atm_key, distance_au=float(distance_au))
+    if key in _SPECTRUM_CACHE:
+        return _SPECTRUM_CACHE[key]
 
     # make rfast from clima results
-    r = make_rfast_from_clima(template_filename, c, distance_au, tmp_atmosphere_outfile, tmp_scr_outfile)
+    r = make_rfast_from_state(template_filename, state, distance_au)
 
     # compute the spectrum
-    F1, F2 = r.genspec_scr()
+    with instrument.stage('genspec_scr', template=template_filename):
+        F1, F2 = r.genspec_scr()
+
+    _SPECTRUM_CACHE[key] = (r, F2)
+    while len(_SPECTRUM_CACHE) > SPECTRUM_CACHE_SIZE:
+        del _SPECTRUM_CACHE[next(iter(_SPECTRUM_CACHE))]
+    return r, F2
+
+def template_list(template_filename):
+    # one template, or a list of templates (bands)
+    if isinstance(template_filename, (list, tuple)):
+        return list(template_filename)
+    return [template_filename]
+
+def make_spectra_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, template_filenames,
+                                        climate_cache_dir=None):
+    # One atmosphere, and a spectrum for each template in template_filenames
+
+    def compute():
+        with instrument.stage('make_profile_bg_gas'):
+            c.make_profile_bg_gas(T_surf, P_i, P_surf, bg_gas)
+    key, state = cached_climate_state(c, 'temperature', compute, climate_cache_dir,
+                                      T_surf=float(T_surf), P_i=np.asarray(P_i, dtype=float),
+                                      P_surf=float(P_surf), bg_gas=bg_gas, T_trop=float(c.T_trop))
+
+    return [spectrum_from_state(template, key, state, 1.0) for template in template_filenames]
+
+def make_spectra_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
+                               template_filenames, warm_start=False, climate_cache_dir=None):
+    # One atmosphere, and a spectrum for each template in template_filenames
+
+    # the CO2 column is what we solve for (and N_i is modified in place by
+    # the solve), so it is not part of the atmospheric state
+    N_i_key = np.array(N_i, dtype=float)
+    N_i_key[c.species_names.index('CO2')] = 0.0
+
+    def compute():
+        find_CO2_for_stable_climate(c, N_i, distance_au, T_surf, N_CO2_guess, T_trop_guess, warm_start)
+    key, state = cached_climate_state(c, 'hz', compute, climate_cache_dir,
+                                      T_surf=float(T_surf), N_i=N_i_key, distance_au=float(distance_au))
+
+    return [spectrum_from_state(template, key, state, distance_au) for template in template_filenames]
+
+def make_spectrum_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, template_filename,
+                                         climate_cache_dir=None):
+    return make_spectra_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, [template_filename],
+                                               climate_cache_dir)[0]
 
+def make_spectrum_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
+                                template_filename, warm_start=False, climate_cache_dir=None):
+    return make_spectra_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
+                                      [template_filename], warm_start, climate_cache_dir)[0]
+
+def make_spectra(c, model, template_filenames, atmosphere, climate_cache_dir=None):
+    # atmosphere is a dict of arguments to the make_spectra_* functions,
+    # with compositions given as dicts of species -> value. Returns a list
+    # of (r, F2), one for each template.
+
+    if model == 'temperature':
+        P_surf = atmosphere['P_surf']
+        P_i = species_array(c, atmosphere['f_i'])*P_surf
+        # partial pressures that override f_i*P_surf (e.g. a water ocean)
+        P_i_override = atmosphere.get('P_i', {})
+        for sp in P_i_override:
+            P_i[c.species_names.index(sp)] = P_i_override[sp]
+        spectra = make_spectra_temperature_experiment(c, atmosphere['T_surf'], P_i, P_surf, 
+                                                      atmosphere['bg_gas'], template_filenames,
+                                                      climate_cache_dir)
+    elif model == 'hz':
+        N_i = species_array(c, atmosphere['N_i'])
+        spectra = make_spectra_hz_experiment(c, atmosphere['T_surf'], N_i, atmosphere['distance_au'], 
+                                             atmosphere['N_CO2_guess'], atmosphere['T_trop_guess'],
+                                             template_filenames, atmosphere.get('warm_start', False),
+                                             climate_cache_dir)
+    else:
+        raise Exception('Unknown model: '+model)
+
+    return spectra
+
+def make_spectrum(c, model, template_filename, atmosphere, climate_cache_dir=None):
+    return make_spectra(c, model, [template_filename], atmosphere, climate_cache_dir)[0]
+
+def make_data_from_spectrum(r, F2, SNR, FpFs_err):
     # set SNR and generate data
     assert r.scr.snr0.shape[0] == 1 
     r.scr.snr0 = np.array([SNR])
-    dat, err = r.noise_at_FpFs(F2, FpFs_err)
+    with instrument.stage('noise_at_FpFs', SNR=float(SNR)):
+        dat, err = r.noise_at_FpFs(F2, FpFs_err)
+    return dat, err
+
+# template_filename can be a list of bands, in which case a list of
+# (dat, err) is returned, one per band, all from the same atmosphere.
+
+def make_data_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, 
+                                     template_filename, SNR, FpFs_err):
+
+    spectra = make_spectra_temperature_experiment(c, T_surf, P_i, P_surf, bg_gas, 
+                                                  template_list(template_filename))
+    data = [make_data_from_spectrum(r, F2, SNR, FpFs_err) for r, F2 in spectra]
+
+    if isinstance(template_filename, (list, tuple)):
+        return data
+    return data[0]
+
+def make_data_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
+                            template_filename, SNR, FpFs_err):
+
+    spectra = make_spectra_hz_experiment(c, T_surf, N_i, distance_au, N_CO2_guess, T_trop_guess,
+                                         template_list(template_filename))
+    data = [make_data_from_spectrum(r, F2, SNR, FpFs_err) for r, F2 in spectra]
 
-    return dat, err
\ No newline at end of file
+    if isinstance(template_filename, (list, tuple)):
+        return data
+    return data[0]
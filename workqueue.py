@@ -0,0 +1,357 @@
+import os
+import sys
+import time
+import pickle
+import socket
+import sqlite3
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+
+import manifest
+import instrument
+
+# A work queue in an SQLite file on a shared filesystem, to spread sweeps
+# over the nodes of an allocation. A coordinator enqueues the jobs of the
+# sweeps: one data job per group of tasks that share an atmosphere (see
+# scheduler.group_tasks) and one retrieval job per retrieval unit, which
+# requires the data job of its task. Any number of workers, on any number of nodes, claim jobs whose
+# requirements are met, run them and mark them done.
+#
+# A claimed job holds a lease, which its worker renews every HEARTBEAT
+# seconds while the job runs. The job of a worker that died goes back to
+# the queue when its lease expires, up to MAX_ATTEMPTS times. Outputs are
+# recorded in the manifests (and stores) of the sweeps as usual, so
+# run_pipeline and the summaries see them. SQLite needs a filesystem with
+# working POSIX locks.
+
+LEASE = 300.0 # seconds
+HEARTBEAT = 30.0
+POLL = 10.0
+MAX_ATTEMPTS = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    kind TEXT,
+    payload BLOB,
+    priority REAL,
+    status TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS deps (
+    job TEXT,
+    requires TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS deps_job ON deps (job);
+'''
+
+# Pending jobs whose requirements are all done
+CLAIMABLE = '''
+SELECT key, kind, payload FROM jobs WHERE status = 'pending' AND NOT EXISTS (
+    SELECT 1 FROM deps JOIN jobs r ON r.key = deps.requires
+    WHERE deps.job = jobs.key AND r.status != 'done')
+ORDER BY priority DESC LIMIT 1
+'''
+
+def connect(db):
+    con = sqlite3.connect(db, timeout=600.0, isolation_level=None)
+    con.executescript(SCHEMA)
+    return con
+
+@contextlib.contextmanager
+def transaction(con):
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except:
+        con.execute('ROLLBACK')
+        raise
+    con.execute('COMMIT')
+
+def add_job(con, key, kind, payload, priority, requires=()):
+    # requires is a list of job keys. Jobs already in the queue are
+    # kept, except that failed ones are retried.
+    cur = con.execute('INSERT OR IGNORE INTO jobs VALUES (?,?,?,?,?,?,?,?,?)',
+                      (key, kind, pickle.dumps(payload), priority, 'pending', None, None, 0, None))
+    if cur.rowcount == 1:
+        for req in requires:
+            con.execute('INSERT INTO deps (job, requires) VALUES (?,?)', (key, req))
+    else:
+        con.execute("UPDATE jobs SET status = 'pending', attempts = 0, error = NULL "
+                    "WHERE key = ? AND status = 'failed'", (key,))
+
+def fail_dependents(con):
+    # jobs with a failed requirement can never run
+    while True:
+        cur = con.execute('''UPDATE jobs SET status = 'failed', error = 'a requirement failed'
+            WHERE status = 'pending' AND key IN (
+                SELECT deps.job FROM deps JOIN jobs r ON r.key = deps.requires
+                WHERE r.status = 'failed')''')
+        if cur.rowcount == 0:
+            break
+
+def requeue_expired(con, now):
+    con.execute("UPDATE jobs SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'running' AND lease_expires < ? AND attempts >= ?", (now, MAX_ATTEMPTS))
+    con.execute("UPDATE jobs SET status = 'pending', worker = NULL "
+                "WHERE status = 'running' AND lease_expires < ?", (now,))
+
+def claim(con, worker):
+    # Returns (key, kind, payload) of a job now leased to worker, or None
+    now = time.time()
+    with transaction(con):
+        requeue_expired(con, now)
+        fail_dependents(con)
+        row = con.execute(CLAIMABLE).fetchone()
+        if row is not None:
+            con.execute("UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, "
+                        "attempts = attempts + 1 WHERE key = ?", (worker, now+LEASE, row[0]))
+    if row is None:
+        return None
+    return row[0], row[1], pickle.loads(row[2])
+
+def heartbeat(con, key, worker):
+    # False if the lease was lost, e.g. it expired and the job was requeued
+    cur = con.execute("UPDATE jobs SET lease_expires = ? WHERE key = ? AND worker = ? AND status = 'running'",
+                      (time.time()+LEASE, key, worker))
+    return cur.rowcount == 1
+
+def complete(con, key, worker):
+    con.execute("UPDATE jobs SET status = 'done', error = NULL WHERE key = ? AND worker = ?", (key, worker))
+
+def fail(con, key, worker, error):
+    with transaction(con):
+        con.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                    "worker = NULL, error = ? WHERE key = ? AND worker = ?", (MAX_ATTEMPTS, error, key, worker))
+        fail_dependents(con)
+
+def remaining(con):
+    row = con.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()
+    return row[0]
+
+def job_counts(con):
+    rows = con.execute('SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status').fetchall()
+    return {(kind, status): n for kind, status, n in rows}
+
+def data_key(group):
+    names = ','.join(sorted(task['filename'] for task in group['tasks']))
+    return 'data:'+hashlib.sha256(names.encode()).hexdigest()
+
+def retrieval_key(task, label):
+    return 'retrieval:'+task['filename']+':'+label
+
+def enqueue(db, tasks, opacity_cache=None):
+    # Adds the jobs of tasks that are not complete
+    import scheduler
+
+    # outputs finished after the process running them was killed are
+    # recorded first
+    nrecovered = 0
+    for save_dir in sorted(set(os.path.dirname(task['filename']) for task in tasks)):
+        with manifest.locked_manifest(save_dir) as m:
+            for task in tasks:
+                if os.path.dirname(task['filename']) != save_dir:
+                    continue
+                for label in ['data'] + [u[0] for u in scheduler.retrieval_units(task)]:
+                    if scheduler.recover_output(m, task, label):
+                        nrecovered += 1
+    if nrecovered > 0:
+        print('%i'%nrecovered+' finished outputs were not in the manifests and have been recorded')
+
+    manifests = {}
+    def task_manifest(task):
+        save_dir = os.path.dirname(task['filename'])
+        if save_dir not in manifests:
+            manifests[save_dir] = manifest.load_manifest(save_dir)
+        return manifests[save_dir]
+
+    todo = {}
+    need_data = []
+    for i,task in enumerate(tasks):
+        m = task_manifest(task)
+        units = [u for u in scheduler.retrieval_units(task) if not manifest.output_valid(m, task['filename'], u[0])]
+        if len(units) == 0:
+            continue
+        todo[i] = units
+        if not manifest.output_valid(m, task['filename'], 'data'):
+            need_data.append(i)
+
+    groups = scheduler.group_tasks([tasks[i] for i in need_data])
+    data_keys = {}
+
+    con = connect(db)
+    with transaction(con):
+        for group in groups:
+            group_tasks = [tasks[need_data[j]] for j in group['tasks']]
+            payload = {'group': group, 'tasks': group_tasks, 'opacity_cache': opacity_cache}
+            key = data_key({'tasks': group_tasks})
+            # data first, so retrievals can start
+            add_job(con, key, 'data', payload, float('inf'))
+            for j in group['tasks']:
+                data_keys[need_data[j]] = key
+
+        for i in todo:
+            task = tasks[i]
+            for label, gas in todo[i]:
+                requires = []
+                if i in data_keys:
+                    requires.append(data_keys[i])
+                payload = {'task': task, 'label': label, 'gas': gas, 'opacity_cache': opacity_cache}
+                # highest SNRs first, as they run longest
+                add_job(con, retrieval_key(task, label), 'retrieval', payload, task['SNR'], requires)
+    print('%i'%len(groups)+' data jobs and '+'%i'%sum(len(u) for u in todo.values())+' retrieval jobs enqueued')
+
+def run_data_job(payload):
+    import scheduler
+
+    group = payload['group']
+    data = scheduler.generate_data(group['model'], group['atmosphere'], group['clima'], group['climate_cache'],
+                                   group['FpFs_err'], group['templates'], group['SNRs'], group.get('instrument'))
+    for task, (lam, dlam, dat, err) in zip(payload['tasks'], data):
+        scheduler.save_data(task, lam, dlam, dat, err)
+        with manifest.locked_manifest(os.path.dirname(task['filename'])) as m:
+            scheduler.record_output(m, task, 'data')
+
+def run_retrieval_job(payload, workers=1):
+    import scheduler
+    import retrieval
+
+    task = payload['task']
+    label = payload['label']
+    save_dir = os.path.dirname(task['filename'])
+    dat, err = scheduler.load_data(task)
+    r = scheduler.get_retrieval(task['template'], task['rpars'])
+    outfile = manifest.output_filename(task['filename'], label)
+
+    if task.get('sampler') is None:
+        p = retrieval.rfast_process(r, dat, err, outfile, payload['gas'])
+        p.join()
+        if p.exitcode != 0:
+            raise Exception('retrieval failed: '+outfile)
+    else:
+        retrieval.run_nested(r, task['rpars'], dat, err, outfile, payload['gas'], workers, **task['sampler'])
+
+    with manifest.locked_manifest(save_dir) as m:
+        scheduler.record_output(m, task, label)
+        done = all(manifest.output_valid(m, task['filename'], u[0]) for u in scheduler.retrieval_units(task))
+        manifest.set_status(m, task['filename'], 'done' if done else 'partial')
+
+def run_job(kind, payload, workers=1):
+    if kind == 'data':
+        run_data_job(payload)
+    else:
+        run_retrieval_job(payload, workers)
+
+def work(db, workers=1):
+    # Claims and runs jobs until the queue is empty. Each job runs in a
+    # child process while we renew its lease.
+    import scheduler
+    import utils
+
+    name = socket.gethostname()+':'+'%i'%os.getpid()
+    con = connect(db)
+    while True:
+        job = claim(con, name)
+        if job is None:
+            if remaining(con) == 0:
+                break
+            time.sleep(POLL)
+            continue
+        key, kind, payload = job
+        print(name+' running '+key)
+
+        # objects kept between jobs are made here, before forking
+        utils.set_opacity_cache(payload['opacity_cache'])
+        if kind == 'data':
+            instrument.set_log(payload['group'].get('instrument'))
+            utils.get_climate(payload['group']['clima'])
+        else:
+            task = payload['task']
+            instrument.set_log(task.get('instrument'))
+            scheduler.get_retrieval(task['template'], task['rpars'])
+            instrument.set_log(task.get('instrument'), point=os.path.basename(task['filename']),
+                               label=payload['label'], SNR=task['SNR'])
+
+        p = multiprocessing.Process(target=run_job, args=(kind, payload, workers))
+        p.start()
+        lost = False
+        while True:
+            p.join(HEARTBEAT)
+            if p.exitcode is not None:
+                break
+            if not heartbeat(con, key, name):
+                lost = True
+                p.terminate()
+                p.join()
+                break
+
+        if lost:
+            print(name+' lost the lease of '+key)
+        elif p.exitcode == 0:
+            complete(con, key, name)
+        else:
+            fail(con, key, name, 'exit code '+'%i'%p.exitcode)
+            print(name+' failed '+key)
+
+def start_workers(db, processes=1, workers=1):
+    procs = [multiprocessing.Process(target=work, args=(db, workers)) for i in range(processes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+def print_status(db):
+    con = connect(db)
+    counts = job_counts(con)
+    fmt = "{:12}"
+    print(fmt.format('')+''.join(fmt.format(s) for s in ['pending', 'running', 'done', 'failed']))
+    for kind in ['data', 'retrieval']:
+        print(fmt.format(kind)+''.join(fmt.format('%i'%counts.get((kind, s), 0))
+                                       for s in ['pending', 'running', 'done', 'failed']))
+
+def main(argv=None):
+    from sweep import load_spec, expand_tasks, run_option
+
+    parser = argparse.ArgumentParser(description='Run sweeps through a work queue shared by several nodes.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('enqueue', help='add the jobs of sweeps to the queue')
+    p.add_argument('db')
+    p.add_argument('specs', nargs='+')
+
+    p = sub.add_parser('worker', help='run jobs until the queue is empty')
+    p.add_argument('db')
+    p.add_argument('--processes', type=int, default=1, help='workers to start on this node')
+    p.add_argument('--retrieval-workers', type=int, default=1, help='likelihood workers per retrieval')
+
+    p = sub.add_parser('status', help='count the jobs in the queue')
+    p.add_argument('db')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'enqueue':
+        specs = [load_spec(a) for a in args.specs]
+        for spec in specs:
+            if not os.path.isdir(spec['save_dir']):
+                raise Exception(spec['save_dir']+' must exist!')
+        tasks = []
+        filenames = set()
+        for spec in specs:
+            for task in expand_tasks(spec):
+                if task['filename'] not in filenames:
+                    filenames.add(task['filename'])
+                    tasks.append(task)
+        enqueue(args.db, tasks, run_option(specs, 'opacity_cache'))
+    elif args.command == 'worker':
+        start_workers(args.db, args.processes, args.retrieval_workers)
+    elif args.command == 'status':
+        print_status(args.db)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])